@@ -8,6 +8,7 @@ from datetime import date
 from calculations.calculations import vapor_pressure
 from calculations.calculations import wind_tot
 from calculations.calculations import rel_hum
+from calculations import encoding
 
 
 # Using code from https://github.com/google-research/arco-era5/blob/main/docs/0-Surface-Reanalysis-Walkthrough.ipynb 
@@ -136,6 +137,8 @@ if __name__ == "__main__":
     parser.add_argument("--year_end", required=True, type=int)
     parser.add_argument("--out_path", required=True, type=str)
     parser.add_argument("--dataset", required=True, type=str)
+    parser.add_argument("--encoding", required=False, type=str, default='float32', choices=encoding.PROFILES)
+    parser.add_argument("--layout", required=False, type=str, default='time', choices=encoding.LAYOUTS)
     args = parser.parse_args()
 
     variable = args.variable
@@ -149,5 +152,5 @@ if __name__ == "__main__":
     # Saving the dataset
     output_file = (out_path + '/ERA5_IL_' + variable + '_' + str(year_start) + '-' + str(year_end) + '_' + 
                    str(date.today()) + '.nc')
-    dataarray.to_netcdf(output_file)
+    encoding.to_netcdf(dataarray, output_file, profile=args.encoding, layout=args.layout)
     print('Dataset saved to ' + output_file)
\ No newline at end of file
@@ -137,6 +137,17 @@ def process(
         "-f",
         help="Output file format (parquet, csv, netcdf)",
     ),
+    encoding: str = typer.Option(
+        "float32",
+        "--encoding",
+        "-e",
+        help="NetCDF encoding profile (none, float32, zstd, packed). 'packed' stores temperatures as int16",
+    ),
+    layout: str = typer.Option(
+        "time",
+        "--layout",
+        help="NetCDF chunk layout: 'time' for maps, 'space' for time series",
+    ),
     output_path: Path = typer.Option(
         "./output",
         "--output-path",
@@ -214,7 +225,9 @@ def process(
 
         # Save the data
         task3 = progress.add_task("Saving data...", total=None)
-        saved_file_path = save_dataset(data, output_file_path, output_format)
+        saved_file_path = save_dataset(
+            data, output_file_path, output_format, encoding=encoding, layout=layout
+        )
         progress.update(task3, completed=True, description="Data saved")
 
     # Show completion message
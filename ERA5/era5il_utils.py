@@ -8,6 +8,7 @@ import regionmask
 import scipy.spatial
 import typer
 import xarray as xr
+from climate_map.calculations import encoding as encoding_profiles
 from climate_map.ERA5.era5il_models import GeographicBoundaries
 
 
@@ -398,7 +399,13 @@ def prepare_climate_grid(
     return ds_out
 
 
-def save_dataset(data: xr.Dataset, filename: Path, format: str) -> str:
+def save_dataset(
+    data: xr.Dataset,
+    filename: Path,
+    format: str,
+    encoding: str = "float32",
+    layout: str = "time",
+) -> str:
     """
     Saves an xarray Dataset to disk in the specified format.
 
@@ -406,6 +413,9 @@ def save_dataset(data: xr.Dataset, filename: Path, format: str) -> str:
         data: xarray Dataset to save
         filename: Base filename (without extension) as a Path object
         format: Output format ('csv', 'parquet', or 'netcdf')
+        encoding: NetCDF encoding profile ('none', 'float32', 'zstd' or 'packed'),
+            see calculations.encoding
+        layout: NetCDF chunk layout, 'time' for maps or 'space' for time series
 
     Returns:
         Path to the saved file
@@ -418,7 +428,9 @@ def save_dataset(data: xr.Dataset, filename: Path, format: str) -> str:
     if format.lower() == "netcdf":
         # Save as NetCDF
         out_file = filename.with_suffix(".nc")
-        data.to_netcdf(str(out_file))
+        encoding_profiles.to_netcdf(
+            data, str(out_file), profile=encoding, layout=layout
+        )
     elif format.lower() == "csv":
         # Convert to DataFrame and save as CSV
         out_file = filename.with_suffix(".csv")
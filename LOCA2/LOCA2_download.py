@@ -5,106 +5,529 @@ Created on Tue Oct  1 11:43:22 2024
 @author: mailes2
 """
 
-import urllib
 from bs4 import BeautifulSoup
 import requests
 import fnmatch
 from pathlib import Path
 import argparse
+import hashlib
+import importlib.util
+import json
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urljoin, urlparse
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import fsspec
+import xarray as xr
+from ERA5.era5il_models import IL_boundaries
+from LOCA2.LOCA2_processor import subset_boundaries
+from calculations import encoding
 
-def file_downloader(variable, path_out):
+
+BASE_URL = "https://cirrus.ucsd.edu/~pierce/LOCA2/CONUS_regions_split/"
+CHUNK_SIZE = 1024**2
+# Size and sha256 of every completed download, kept in path_out
+MANIFEST = 'download_manifest.json'
+# Parsed index pages, revalidated with ETag/Last-Modified (location can be moved with CLIMATE_MAP_CACHE)
+INDEX_CACHE = Path(os.environ.get('CLIMATE_MAP_CACHE', Path.home() / '.cache' / 'climate_map')) / 'loca2_index.json'
+SCENARIOS = ['historical', 'ssp245', 'ssp370', 'ssp585']
+# Bytes fetched per range request when streaming a remote file
+BLOCK_SIZE = 8 * 1024**2
+
+
+_local = threading.local()
+_host_lock = threading.Lock()
+_host_limits = {}
+
+
+def get_session(max_connections=4):
+    """
+    Keep-alive session of the current thread, so connections get reused between requests
+
+    Input:
+    - max_connections (int) - Connections kept open per host (the per host limit of the run)
+
+    Output:
+    - session (Session)
+
+    """
+    sessions = getattr(_local, 'sessions', None)
+    if sessions is None:
+        sessions = _local.sessions = {}
+    if max_connections not in sessions:
+        session = requests.Session()
+        retries = Retry(total=5, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504])
+        adapter = HTTPAdapter(pool_connections=max_connections, pool_maxsize=max_connections, max_retries=retries)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        sessions[max_connections] = session
+    return sessions[max_connections]
+
+
+
+def host_limit(url, per_host):
+    """
+    Semaphore capping the number of requests in flight to the host of url. Runs with a different 
+    per_host get their own semaphore.
+
+    """
+    key = (urlparse(url).netloc, per_host)
+    with _host_lock:
+        if key not in _host_limits:
+            _host_limits[key] = threading.BoundedSemaphore(per_host)
+        return _host_limits[key]
+
+
+
+class IndexCache:
+    def __init__(self, path=INDEX_CACHE):
+        """
+        Links of every directory index page visited, saved between runs. Pages are fetched again 
+        with a conditional GET (If-None-Match/If-Modified-Since), so only pages that changed 
+        get transferred and parsed. Pages the server sends without an ETag or Last-Modified are 
+        always fetched.
+
+        Input:
+        - path (str) - JSON file holding the cache
+        """
+        self.path = Path(path)
+        self.lock = threading.Lock()
+        self.pages = read_manifest(self.path)
+        self.revalidated = 0
+        self.fetched = 0
+
+    def links(self, path_string, per_host=4):
+        """
+        Links on a directory index page
+
+        Input:
+        - path_string (str) - URL of the directory
+        - per_host (int) - Most requests in flight to one host
+
+        Output:
+        - file_list (list) - href of every link on the page
+
+        """
+        with self.lock:
+            cached = self.pages.get(path_string)
+        headers = {}
+        if cached is not None and cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        if cached is not None and cached.get('last_modified'):
+            headers['If-Modified-Since'] = cached['last_modified']
+
+        with host_limit(path_string, per_host):
+            response = get_session(per_host).get(path_string, timeout=60, headers=headers)
+        if response.status_code == 304 and cached is not None:
+            with self.lock:
+                self.revalidated += 1
+            return cached['links']
+        response.raise_for_status()
+
+        path_soup = BeautifulSoup(response.text, 'html.parser') # Parsing the website to look for the download
+        file_list = [file.get('href') for file in path_soup.find_all('a') if file.get('href')]
+        with self.lock:
+            self.fetched += 1
+            self.pages[path_string] = {'etag': response.headers.get('ETag'), 
+                                       'last_modified': response.headers.get('Last-Modified'),
+                                       'links': file_list}
+        return file_list
+
+    def save(self):
+        """
+        Writes the cache to disk
+        
+        """
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self.lock:
+            write_manifest(self.path, self.pages)
+
+
+
+def subdirectories(file_list):
+    """
+    Subdirectories linked from an index page (leaving out the parent directory and sorting links)
+
+    """
+    return [href.rstrip('/') for href in file_list 
+            if href.endswith('/') and not href.startswith(('/', '.', '?', 'http')) and '/' not in href.rstrip('/')]
+
+
+
+def discover_models(variable, base_url, cache, pool, per_host=4):
+    """
+    Finds which models, scenarios and member IDs have a variable on the server, by walking 
+    the index pages (model/cent/0p0625deg/member/scenario/variable)
+
+    Input:
+    - variable (str) - pr, tasmax, tasmin
+    - base_url (str) - Root of the LOCA2 server
+    - cache (IndexCache) - Cached index pages
+    - pool (ThreadPoolExecutor) - Threads reading the index pages
+    - per_host (int) - Most requests in flight to one host
+
+    Output:
+    - models (dict) - Model to scenario to set of member IDs
+
+    """
+    def listing(path_string):
+        try:
+            return subdirectories(cache.links(path_string, per_host))
+        except requests.RequestException as error:
+            if not (isinstance(error, requests.HTTPError) and error.response is not None and 
+                    error.response.status_code == 404):
+                print("Couldn't list", path_string, '-', error)
+            return []
+
+    model_list = listing(base_url)
+    member_urls = [urljoin(base_url, model + "/cent/0p0625deg/") for model in model_list]
+    members = dict(zip(model_list, pool.map(listing, member_urls)))
+
+    keys = [(model, memberid) for model in model_list for memberid in members[model]]
+    scenarios = pool.map(listing, [urljoin(base_url, model + "/cent/0p0625deg/" + memberid + "/") 
+                                   for model, memberid in keys])
+    keys = [(model, memberid, scenario) for (model, memberid), found in zip(keys, scenarios) 
+            for scenario in found if scenario in SCENARIOS]
+    variables = pool.map(listing, [urljoin(base_url, model + "/cent/0p0625deg/" + memberid + "/" + scenario + "/") 
+                                   for model, memberid, scenario in keys])
+
+    models = {}
+    for (model, memberid, scenario), found in zip(keys, variables):
+        if variable in found:
+            models.setdefault(model, {}).setdefault(scenario, set()).add(memberid)
+    return models
+
+
+
+def read_manifest(path):
+    """
+    Reads a download manifest (empty if there isn't one yet)
+
+    """
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+
+def write_manifest(path, manifest):
+    """
+    Writes a download manifest
+
+    """
+    tmp = str(path) + '.' + str(os.getpid()) + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp, path) # Atomic, so an interruption never leaves a broken manifest
+
+
+
+def file_sha256(path):
+    """
+    sha256 of a file, read in chunks
+
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+
+def download_file(url, destination, per_host=4, expected=None):
+    """
+    Downloads one file into destination + ".part", resuming with an HTTP Range request if a partial 
+    file is already there. Once the size matches the server's (and the sha256 matches expected, 
+    if given) the file is renamed to destination, so destination is never a truncated file.
+
+    Input:
+    - url (str) - File to download
+    - destination (Path) - Where to save it
+    - per_host (int) - Most downloads in flight to one host
+    - expected (dict) - Manifest entry to verify against ({'size': ..., 'sha256': ...}), if known
+
+    Output:
+    - size (int) - Bytes downloaded (not counting bytes resumed from)
+    - entry (dict) - Manifest entry of the file: size and sha256
+
+    """
+    part = destination.with_name(destination.name + '.part')
+    offset = part.stat().st_size if part.is_file() else 0
+    size = 0
+    restart = False
+
+    with host_limit(url, per_host):
+        headers = {'Range': 'bytes=' + str(offset) + '-'} if offset > 0 else {}
+        with get_session(per_host).get(url, stream=True, timeout=60, headers=headers) as response:
+            content_range = response.headers.get('Content-Range', '')
+            total = re.search(r'/(\d+)$', content_range)
+            total = int(total.group(1)) if total else None
+
+            if response.status_code == 416:
+                # Either the partial file was already complete, or it doesn't fit the file on the server anymore
+                restart = total != offset
+            else:
+                response.raise_for_status()
+
+                if response.status_code != 206 or not content_range.startswith('bytes ' + str(offset) + '-'):
+                    offset = 0 # The server sent the whole file
+                if total is None and 'Content-Length' in response.headers:
+                    total = offset + int(response.headers['Content-Length'])
+
+                with open(part, 'ab' if offset > 0 else 'wb') as f:
+                    for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                        f.write(chunk)
+                        size += len(chunk)
+
+    if restart:
+        part.unlink()
+        return download_file(url, destination, per_host, expected)
+
+    # Verifying before the file gets its real name
+    part_size = part.stat().st_size
+    if total is not None and part_size != total:
+        raise OSError(str(part) + " is " + str(part_size) + " bytes, expected " + str(total) + " (will resume)")
+    if expected is not None and expected.get('size') not in (None, part_size):
+        part.unlink()
+        raise ValueError(str(destination) + " doesn't match the size in the manifest")
+    sha256 = file_sha256(part)
+    if expected is not None and expected.get('sha256') not in (None, sha256):
+        part.unlink()
+        raise ValueError(str(destination) + " doesn't match the checksum in the manifest")
+
+    os.replace(part, destination)
+    return size, {'size': part_size, 'sha256': sha256}
+
+
+
+def adopt_file(url, destination, per_host=4):
+    """
+    Checks a file downloaded before the manifest existed against the server's size (HEAD request). 
+    A complete file is only hashed for the manifest, anything else is resumed as a partial download.
+
+    Input:
+    - url (str) - File on the server
+    - destination (Path) - File already on disk
+    - per_host (int) - Most requests in flight to one host
+
+    Output:
+    - size (int) - Bytes downloaded (None if the file was already complete)
+    - entry (dict) - Manifest entry of the file: size and sha256
+
+    """
+    with host_limit(url, per_host):
+        response = get_session(per_host).head(url, timeout=60, allow_redirects=True)
+    response.raise_for_status()
+    length = response.headers.get('Content-Length')
+
+    if length is not None and int(length) == destination.stat().st_size:
+        return None, {'size': int(length), 'sha256': file_sha256(destination)}
+
+    os.replace(destination, destination.with_name(destination.name + '.part'))
+    return download_file(url, destination, per_host)
+
+
+
+def subset_file(url, destination, boundaries=IL_boundaries, per_host=4, profile='float32', block_size=BLOCK_SIZE):
+    """
+    Streams a remote netCDF file and saves only the part inside a bounding box. The file is read
+    through range requests (fsspec + h5netcdf), so only the blocks holding the bounding box are 
+    transferred when the file is chunked spatially. The subset is written compressed to 
+    destination + ".part" and renamed once complete.
+
+    Input:
+    - url (str) - File to stream
+    - destination (Path) - Where to save the subset
+    - boundaries (GeographicBoundaries) - Bounding box to keep (default: Illinois, same as loca2_processing)
+    - per_host (int) - Most downloads in flight to one host
+    - profile (str) - Encoding profile of the subset (see calculations.encoding)
+    - block_size (int) - Bytes fetched per range request
+
+    Output:
+    - size (int) - Bytes written
+    - entry (dict) - Manifest entry of the file: size, sha256 and the bounding box
+
+    """
+    if importlib.util.find_spec('aiohttp') is None:
+        raise ImportError("Streaming subsets over HTTP needs aiohttp (pip install aiohttp)")
+
+    part = destination.with_name(destination.name + '.part')
+    with host_limit(url, per_host):
+        with fsspec.open(url, 'rb', block_size=block_size) as f:
+            # Times are kept as they are on the server (model calendar), like the full files
+            with xr.open_dataset(f, engine='h5netcdf', decode_times=False) as dataset:
+                subset = subset_boundaries(dataset, boundaries).load()
+
+    encoding.to_netcdf(subset, str(part), profile=profile)
+    os.replace(part, destination)
+    size = destination.stat().st_size
+    return size, {'size': size, 'sha256': file_sha256(destination), 'subset': bounds(boundaries)}
+
+
+
+def bounds(boundaries):
+    """
+    Bounding box as a list, for the manifest
+    
+    """
+    return [boundaries.lon_min, boundaries.lon_max, boundaries.lat_min, boundaries.lat_max]
+
+
+
+def find_downloads(variable, path_out, base_url, model, scenario, memberid, cache, per_host=4):
+    """
+    Files to download for one model, scenario and member ID
+
+    Output:
+    - downloads (list) - (URL, destination) of every full daily file
+
+    """
+    # Putting together the URL of the data location
+    path_string = urljoin(base_url, model + "/cent/0p0625deg/" + memberid + "/" + scenario + "/" + variable + "/")
+    file_list = cache.links(path_string, per_host)
+    file_string = (variable + "." + model + "." + scenario + "." + memberid + ".*.LOCA_16thdeg_*.cent.nc")
+    filtered = fnmatch.filter(file_list, file_string) # Looking for specifically the full daily dataset
+    directory = Path(path_out) / model / scenario # Pulling out the directory to download into
+    return [(path_string + filefiltered, directory / filefiltered) for filefiltered in filtered 
+            if 'monthly' not in filefiltered]
+
+
+
+def file_downloader(variable, path_out, base_url=BASE_URL, models=None, max_workers=8, per_host=4, verify=False,
+                    index_cache=INDEX_CACHE, subset=None, profile='float32'):
     """
     
     This function downloads all daily LOCA2 files for a given variable into a given directory.
+    Index pages and files are fetched by a pool of threads, each with its own keep-alive session.
+    Downloads go to .part files that are resumed if interrupted, and are only renamed once complete. 
+    The size and sha256 of every completed file are kept in path_out/download_manifest.json.
     
     Input:
     - variable (str) - pr (Precipitation), tasmax (Maximum temperature), or tasmin (Minimum temperature)
     - path_out (str) - Location to download the LOCA2 files to 
-        - This directory needs subdirectories set up by create_dir.sh to work.
+        - Subdirectories (model/scenario) are created as needed.
+    - base_url (str) - Root of the LOCA2 server (can point to a local server for testing)
+    - models (dict) - Model to scenario to member IDs to download (default: everything on the server 
+        that has variable)
+    - max_workers (int) - Number of requests in flight
+    - per_host (int) - Most requests in flight to one host
+    - verify (bool) - If True, files already downloaded are checked against the manifest's sha256 
+        (otherwise only their size is checked)
+    - index_cache (str) - JSON file caching the index pages between runs
+    - subset (GeographicBoundaries) - If given, each file is streamed and only this bounding box is saved 
+        (as <name>.subset.nc) instead of downloading the whole file
+    - profile (str) - Encoding profile of the subsets (see calculations.encoding)
     
     Output:
-    - None
-
-    """
-    models_dict = \
-        { "ACCESS-CM2": {"historical": {"r1i1p1f1","r2i1p1f1","r3i1p1f1"}, "ssp245": {"r1i1p1f1","r2i1p1f1","r3i1p1f1"}, 
-                         "ssp370": {"r1i1p1f1","r2i1p1f1","r3i1p1f1"}, "ssp585": {"r1i1p1f1","r2i1p1f1","r3i1p1f1"}},
-         "ACCESS-ESM1-5": {"historical": {"r1i1p1f1","r2i1p1f1","r3i1p1f1","r4i1p1f1","r5i1p1f1"}, "ssp245": {"r1i1p1f1","r2i1p1f1","r3i1p1f1","r4i1p1f1","r5i1p1f1"},
-                   "ssp370": {"r1i1p1f1","r2i1p1f1","r3i1p1f1","r4i1p1f1","r5i1p1f1"}, "ssp585": {"r1i1p1f1","r2i1p1f1","r3i1p1f1","r4i1p1f1","r5i1p1f1"}}, 
- "AWI-CM-1-1-MR": {"historical": {"r1i1p1f1","r2i1p1f1","r3i1p1f1","r4i1p1f1","r5i1p1f1"}, "ssp245": {"r1i1p1f1"}, "ssp370": {"r1i1p1f1","r2i1p1f1","r3i1p1f1","r4i1p1f1","r5i1p1f1"}, 
-                   "ssp585": {"r1i1p1f1"}}, 
-         "BCC-CSM2-MR": {"historical": {"r1i1p1f1"}, "ssp245": {"r1i1p1f1"}, "ssp370": {"r1i1p1f1"}, "ssp585": {"r1i1p1f1"}}, 
- "CESM2-LENS": {"historical": {"r1i1p1f1","r2i1p1f1","r3i1p1f1","r4i1p1f1","r5i1p1f1","r6i1p1f1","r7i1p1f1","r8i1p1f1","r9i1p1f1","r10i1p1f1"}, 
-                "ssp370": {"r1i1p1f1","r2i1p1f1","r3i1p1f1","r4i1p1f1","r5i1p1f1","r6i1p1f1","r7i1p1f1","r8i1p1f1","r9i1p1f1","r10i1p1f1"}}, 
- "CNRM-CM6-1": {"historical": {"r1i1p1f2"}, "ssp245": {"r1i1p1f2"}, "ssp370": {"r1i1p1f2"}, "ssp585": {"r1i1p1f2"}},
- "CNRM-CM6-1-HR": {"historical": {"r1i1p1f2"}, "ssp585": {"r1i1p1f2"}}, 
- "CNRM-ESM2-1": {"historical": {"r1i1p1f2"}, "ssp245": {"r1i1p1f2"}, "ssp370": {"r1i1p1f2"}, "ssp585": {"r1i1p1f2"}},
- "CanESM5": {"historical": {"r1i1p1f1","r2i1p1f1","r3i1p1f1","r4i1p1f1","r5i1p1f1","r6i1p1f1","r7i1p1f1"}, "ssp245": {"r1i1p1f1","r2i1p1f1","r3i1p1f1","r4i1p1f1","r5i1p1f1","r6i1p1f1","r7i1p1f1"},
-             "ssp370": {"r1i1p1f1","r2i1p1f1","r3i1p1f1","r4i1p1f1","r5i1p1f1","r6i1p1f1","r7i1p1f1"},  "ssp585": {"r1i1p1f1","r2i1p1f1","r3i1p1f1","r4i1p1f1","r5i1p1f1","r6i1p1f1","r7i1p1f1"}}, 
- "EC-Earth3": {"historical": {"r1i1p1f1","r2i1p1f1","r3i1p1f1","r4i1p1f1"},  "ssp245": {"r1i1p1f1","r2i1p1f1","r4i1p1f1"},  "ssp370": {"r1i1p1f1","r4i1p1f1"},
-               "ssp585": {"r1i1p1f1","r3i1p1f1","r4i1p1f1"}}, 
- "EC-Earth3-Veg": {"historical": {"r1i1p1f1","r2i1p1f1","r3i1p1f1","r4i1p1f1","r5i1p1f1"}, "ssp245": {"r1i1p1f1","r2i1p1f1","r3i1p1f1","r4i1p1f1","r5i1p1f1"},
-                   "ssp370": {"r1i1p1f1","r2i1p1f1","r3i1p1f1","r4i1p1f1"}, "ssp585": {"r1i1p1f1","r2i1p1f1","r3i1p1f1","r4i1p1f1"}}, 
- "FGOALS-g3": {"historical": {"r1i1p1f1","r3i1p1f1","r4i1p1f1","r5i1p1f1"}, "ssp245": {"r1i1p1f1","r3i1p1f1","r4i1p1f1"}, "ssp370": {"r1i1p1f1","r3i1p1f1","r4i1p1f1","r5i1p1f1"},  
-               "ssp585": {"r1i1p1f1","r3i1p1f1","r4i1p1f1"}}, 
- "GFDL-CM4": {"historical": {"r1i1p1f1"},  "ssp245": {"r1i1p1f1"}, "ssp585": {"r1i1p1f1"}},  
- "GFDL-ESM4": {"historical": {"r1i1p1f1"}, "ssp245": {"r1i1p1f1"},  "ssp370": {"r1i1p1f1"},  "ssp585": {"r1i1p1f1"}}, 
- "HadGEM3-GC31-LL": {"historical": {"r1i1p1f3","r2i1p1f3","r3i1p1f3"}, "ssp245": {"r1i1p1f3"}, "ssp585": {"r1i1p1f3","r2i1p1f3","r3i1p1f3"}}, 
- "HadGEM3-GC31-MM": {"historical": {"r1i1p1f3","r2i1p1f3"},  "ssp585": {"r1i1p1f3","r2i1p1f3"}},  
- "INM-CM4-8": {"historical": {"r1i1p1f1"}, "ssp245": {"r1i1p1f1"}, "ssp370": {"r1i1p1f1"}, "ssp585": {"r1i1p1f1"}},  
- "INM-CM5-0": {"historical": {"r1i1p1f1","r2i1p1f1","r3i1p1f1","r4i1p1f1","r5i1p1f1"}, "ssp245": {"r1i1p1f1"}, "ssp370": {"r1i1p1f1","r2i1p1f1","r3i1p1f1","r4i1p1f1","r5i1p1f1"},  
-               "ssp585": {"r1i1p1f1"}},  
- "IPSL-CM6A-LR": {"historical": {"r1i1p1f1","r2i1p1f1","r3i1p1f1","r4i1p1f1","r5i1p1f1","r6i1p1f1","r7i1p1f1","r8i1p1f1","r9i1p1f1","r10i1p1f1"}, 
-                  "ssp245": {"r1i1p1f1","r2i1p1f1","r3i1p1f1","r4i1p1f1","r5i1p1f1"},  
-                  "ssp370": {"r1i1p1f1","r2i1p1f1","r3i1p1f1","r4i1p1f1","r5i1p1f1","r6i1p1f1","r7i1p1f1","r8i1p1f1","r9i1p1f1","r10i1p1f1"}, 
-                  "ssp585": {"r1i1p1f1","r2i1p1f1","r3i1p1f1","r4i1p1f1"}}, 
- "KACE-1-0-G": {"historical": {"r1i1p1f1","r2i1p1f1","r3i1p1f1"}, "ssp245": {"r1i1p1f1","r2i1p1f1","r3i1p1f1"}, "ssp370": {"r1i1p1f1","r2i1p1f1","r3i1p1f1"},  
-                "ssp585": {"r1i1p1f1","r2i1p1f1","r3i1p1f1"}}, 
- "MIROC6": {"historical": {"r1i1p1f1","r2i1p1f1","r3i1p1f1","r4i1p1f1","r5i1p1f1"}, "ssp245": {"r1i1p1f1","r2i1p1f1","r3i1p1f1"}, "ssp370": {"r1i1p1f1","r2i1p1f1","r3i1p1f1"},
-            "ssp585": {"r1i1p1f1","r2i1p1f1","r3i1p1f1","r4i1p1f1","r5i1p1f1"}},
- "MPI-ESM1-2-HR": {"historical": {"r1i1p1f1","r2i1p1f1","r3i1p1f1","r4i1p1f1","r5i1p1f1","r6i1p1f1","r7i1p1f1","r8i1p1f1","r9i1p1f1","r10i1p1f1"}, "ssp245": {"r1i1p1f1","r2i1p1f1"}, 
-                   "ssp370": {"r1i1p1f1","r2i1p1f1","r3i1p1f1","r4i1p1f1","r5i1p1f1","r6i1p1f1","r7i1p1f1","r8i1p1f1","r9i1p1f1","r10i1p1f1"}, "ssp585": {"r1i1p1f1","r2i1p1f1"}}, 
- "MPI-ESM1-2-LR": {"historical": {"r1i1p1f1","r2i1p1f1","r3i1p1f1","r4i1p1f1","r5i1p1f1","r6i1p1f1","r7i1p1f1","r8i1p1f1","r10i1p1f1"}, 
-                   "ssp245": {"r1i1p1f1","r2i1p1f1","r3i1p1f1","r4i1p1f1","r5i1p1f1","r6i1p1f1","r7i1p1f1","r8i1p1f1","r10i1p1f1"}, 
-                   "ssp370": {"r1i1p1f1","r2i1p1f1","r3i1p1f1","r4i1p1f1","r5i1p1f1","r7i1p1f1","r8i1p1f1","r10i1p1f1"}, 
-                   "ssp585": {"r1i1p1f1","r2i1p1f1","r3i1p1f1","r4i1p1f1","r5i1p1f1","r6i1p1f1","r7i1p1f1","r8i1p1f1","r10i1p1f1"}}, 
- "MRI-ESM2-0": {"historical": {"r1i1p1f1","r2i1p1f1","r3i1p1f1","r4i1p1f1","r5i1p1f1"}, "ssp245": {"r1i1p1f1"}, "ssp370": {"r1i1p1f1","r2i1p1f1","r3i1p1f1","r4i1p1f1","r5i1p1f1"}, 
-                "ssp585": {"r1i1p1f1"}}, 
- "NorESM2-LM": {"historical": {"r1i1p1f1","r2i1p1f1","r3i1p1f1"}, "ssp245": {"r1i1p1f1","r2i1p1f1","r3i1p1f1"}, "ssp370": {"r1i1p1f1"}, "ssp585": {"r1i1p1f1"}}, 
- "NorESM2-MM": {"historical": {"r1i1p1f1","r2i1p1f1"}, "ssp245": {"r1i1p1f1","r2i1p1f1"}, "ssp370": {"r1i1p1f1"}, "ssp585": {"r1i1p1f1"}}, 
- "TaiESM1": {"historical": {"r1i1p1f1"}, "ssp245": {"r1i1p1f1"}, "ssp370": {"r1i1p1f1"}} }
-    
-    for model in models_dict:
-        for scenario in models_dict[model]:
-            for memberid in models_dict[model][scenario]:
-                # Putting together the URL of the data location
-                path_string = ("https://cirrus.ucsd.edu/~pierce/LOCA2/CONUS_regions_split/" + model + "/cent/0p0625deg/" + memberid + "/" + 
-                               scenario + "/" + variable + "/")
-                path_soup = BeautifulSoup(urllib.request.urlopen(path_string), 'html.parser') # Parsing the website to look for the download
-                file_list = []
-                for file in path_soup.find_all('a'): # Pulling the links
-                    file_list.append(file.get('href'))
-                file_string = (variable + "." + model + "." + scenario + "." + memberid + ".*.LOCA_16thdeg_*.cent.nc")
-                filtered = fnmatch.filter(file_list, file_string) # Looking for specifically the full daily dataset
-                directory = (path_out + "/" + model + "/" + scenario + "/") # Pulling out the directory to download into
-                print(directory)
-                for filefiltered in [x for x in filtered if 'monthly' not in x]:
-                  full_string = path_string + filefiltered # Putting together the full URL
-                  print(full_string)
-                
-                  opener = urllib.request.URLopener()
-                  if not Path(directory+filefiltered).is_file():
-                    opener.retrieve(full_string, (directory+filefiltered)) # Downloading
-                    print("Downloaded!")
-                  else:
-                    print("Already downloaded. Skipping")
+    - summary (dict) - Number of files downloaded, skipped and failed, bytes saved and seconds taken
+
+    """
+    start = time.perf_counter()
+    cache = IndexCache(index_cache)
+    summary = {'downloaded': 0, 'skipped': 0, 'failed': 0, 'bytes': 0}
+    manifest_path = Path(path_out) / MANIFEST
+    manifest = read_manifest(manifest_path)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        # Reading the index pages
+        if models is None:
+            models = discover_models(variable, base_url, cache, pool, per_host)
+        futures = {pool.submit(find_downloads, variable, path_out, base_url, model, scenario, memberid, cache, per_host): 
+                   (model, scenario, memberid)
+                   for model in models for scenario in models[model] for memberid in models[model][scenario]}
+        downloads = []
+        for future in as_completed(futures):
+            try:
+                downloads += future.result()
+            except requests.RequestException as error:
+                print("Couldn't list", '/'.join(futures[future]), '-', error)
+                summary['failed'] += 1
+        cache.save()
+        print(cache.fetched, 'index pages fetched,', cache.revalidated, 'unchanged')
+
+        # Downloading
+        futures = {}
+        for full_string, destination in sorted(downloads):
+            if subset is not None:
+                destination = destination.with_suffix('.subset.nc')
+            key = destination.relative_to(path_out).as_posix()
+            expected = manifest.get(key)
+            if subset is not None:
+                if (destination.is_file() and expected is not None and expected.get('subset') == bounds(subset) and
+                    destination.stat().st_size == expected['size']):
+                    print("Already downloaded. Skipping", destination.name)
+                    summary['skipped'] += 1
+                    continue
+                destination.parent.mkdir(parents=True, exist_ok=True)
+                futures[pool.submit(subset_file, full_string, destination, subset, per_host, profile)] = (full_string, key)
+                continue
+            if destination.is_file():
+                if (expected is not None and destination.stat().st_size == expected['size'] and 
+                    (not verify or file_sha256(destination) == expected['sha256'])):
+                    print("Already downloaded. Skipping", destination.name)
+                    summary['skipped'] += 1
+                    continue
+                if expected is None:
+                    # Downloaded before the manifest: compared with the server's size, resumed if truncated
+                    futures[pool.submit(adopt_file, full_string, destination, per_host)] = (full_string, key)
+                    continue
+                # Not matching the manifest: resumed if truncated, downloaded again otherwise
+                part = destination.with_name(destination.name + '.part')
+                os.replace(destination, part)
+                if part.stat().st_size >= expected['size']:
+                    part.unlink() # Corrupt, starting over
+                    expected = None
+                manifest.pop(key, None)
+            destination.parent.mkdir(parents=True, exist_ok=True)
+            futures[pool.submit(download_file, full_string, destination, per_host, expected)] = (full_string, key)
+
+        for i, future in enumerate(as_completed(futures), start=1):
+            full_string, key = futures[future]
+            try:
+                size, entry = future.result()
+                manifest[key] = entry
+                write_manifest(manifest_path, manifest)
+                if size is None:
+                    print('[' + str(i) + '/' + str(len(futures)) + '] Already downloaded, added to the manifest', 
+                          full_string.split('/')[-1])
+                    summary['skipped'] += 1
+                    continue
+                summary['bytes'] += size
+                summary['downloaded'] += 1
+                rate = summary['bytes'] / 1024**2 / (time.perf_counter() - start)
+                print('[' + str(i) + '/' + str(len(futures)) + '] Downloaded!', full_string.split('/')[-1], 
+                      '(' + format(rate, '.1f') + ' MB/s)')
+            except Exception as error: # One failed file (HTTP, fsspec or netCDF error) doesn't stop the others
+                print('[' + str(i) + '/' + str(len(futures)) + '] Failed', full_string, '-', error)
+                summary['failed'] += 1
+
+    summary['seconds'] = time.perf_counter() - start
+    print(summary['downloaded'], 'downloaded,', summary['skipped'], 'skipped,', summary['failed'], 'failed -', 
+          format(summary['bytes'] / 1024**3, '.2f'), 'GB in', format(summary['seconds'], '.0f'), 's (' + 
+          format(summary['bytes'] / 1024**2 / max(summary['seconds'], 1e-9), '.1f') + ' MB/s)')
+    return summary
     
 if __name__ == "__main__":
   parser = argparse.ArgumentParser()
   parser.add_argument("--variable", required=True, type=str)
   parser.add_argument("--path_out", required=True, type=str)
+  parser.add_argument("--base_url", required=False, type=str, default=BASE_URL)
+  parser.add_argument("--max_workers", required=False, type=int, default=8)
+  parser.add_argument("--per_host", required=False, type=int, default=4)
+  parser.add_argument("--verify", action='store_true', help="Check the sha256 of files already downloaded")
+  parser.add_argument("--index_cache", required=False, type=str, default=str(INDEX_CACHE))
+  parser.add_argument("--subset", action='store_true', help="Stream each file and only save the Illinois box")
+  parser.add_argument("--encoding", required=False, type=str, default='float32', choices=encoding.PROFILES)
   args = parser.parse_args()
 
   variable = args.variable
   path_out = args.path_out
-  file_downloader(variable, path_out)
+  file_downloader(variable, path_out, base_url=args.base_url, max_workers=args.max_workers, per_host=args.per_host, 
+                  verify=args.verify, index_cache=args.index_cache, 
+                  subset=IL_boundaries if args.subset else None, profile=args.encoding)
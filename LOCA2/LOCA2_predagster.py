@@ -5,6 +5,9 @@ from dotenv import load_dotenv
 import numpy as np
 import geopandas
 import pandas as pd
+from calculations.aggregation import cell_polygons
+from ERA5.era5il_models import IL_boundaries
+from calculations.ensemble import reduce_runs, stack_runs
 
 
 
@@ -133,6 +136,51 @@ class OpenLocaCat:
         dataset_full['time'] = datetimeindex
         
         return dataset_full
+
+    def load_runs(self, query):
+        """
+        Loads a LOCA2 dataset like load, but with every scheme, model and member ID that exists stacked 
+        along a single "run" dimension instead of a scheme x model x member_id cube padded with NaN 
+        (models have anywhere from 1 to 10 members)
+
+        Input:
+            - query (Dictionary) - Same as load
+
+        Output:
+            - dataset_runs (Dataset) - Dataset with the dimensions run, lat, lon, and time. run is indexed by
+                    (scheme, model, member_id), so dataset_runs.sel(model='ACCESS-CM2') picks out a model and 
+                    means(dataset_runs, ['model']) averages across models.
+
+        """
+        catalog_subset = self.catalog.search(**query)
+        
+        dsets = catalog_subset.to_dataset_dict(
+                                    xarray_open_kwargs={"use_cftime": True, "engine": 'zarr'},
+                                    storage_options={"anon": True, "endpoint_url": os.environ['S3_ENDPOINT_URL']}
+                                    )
+
+        # Pieces of each run, by variable
+        pieces = {}
+        for dataset_key in dsets:
+            dataset = dsets[dataset_key]
+            run = (dataset.attrs['intake_esm_attrs:scheme'], dataset.attrs['intake_esm_attrs:model'],
+                   dataset.attrs['intake_esm_attrs:experiment_id'])
+            pieces.setdefault(run, {}).setdefault(dataset.attrs['intake_esm_attrs:variable'], []).append(dataset)
+
+        runs = []
+        for run in pieces:
+            list_var = []
+            for variable in pieces[run]:
+                # Sort dataset so it's in chronological order
+                list_id = sorted(pieces[run][variable], key=lambda x:x.attrs['intake_esm_attrs:time_range'])
+                list_var.append(xr.concat(list_id, 'time', coords='minimal', compat='equals'))
+            runs.append((run, xr.merge(list_var, combine_attrs='drop_conflicts')))
+
+        dataset_runs = stack_runs(runs, levels=('scheme', 'model', 'member_id'))
+        datetimeindex = dataset_runs.indexes['time'].to_datetimeindex()
+        dataset_runs['time'] = datetimeindex
+
+        return dataset_runs
         
     def means(self, dataset, coords):
         """
@@ -142,7 +190,8 @@ class OpenLocaCat:
     
         Input:
             - dataset (Dataset or Dataarray) - An xarray dataset to have means done across each variable
-            - coords (List of strings) - Takes mean across each dim. given in order of the list
+            - coords (List of strings) - Takes mean across each dim. given in order of the list. Levels of
+                    a "run" dimension (from load_runs) work the same as dimensions.
         
         Output:
             - data_stats (Dataset) - Contains means across designated coords of the dataset
@@ -157,7 +206,10 @@ class OpenLocaCat:
 
         # Iterating over each coordinate
         for coord in coords:
-            dataset_mean = dataset_mean.mean(coord)
+            if 'run' in dataset_mean.dims and coord in dataset_mean.indexes['run'].names:
+                dataset_mean = reduce_runs(dataset_mean, 'mean', coord)
+            else:
+                dataset_mean = dataset_mean.mean(coord)
             #dataset_stdev = dataset_stdev.std(coord)
             #dataset_var = dataset_var.var(coord)
             
@@ -169,30 +221,43 @@ class OpenLocaCat:
         #data_stats = xr.concat([dataset_mean, dataset_stdev, dataset_var], 'stats')
         return dataset_mean
     
-    def illinois(self, dataset):
+    def illinois(self, dataset, boundaries=IL_boundaries):
         """
-        Returns the dataset to the area surrounding Illinois
+        Returns the dataset to the area surrounding Illinois (or any other bounding box given)
 
         """
-        dataset_ill = dataset.sel(lat=slice(36,43.5)).sel(lon=slice(267.2,274))
+        dataset_ill = dataset.sel(lat=slice(boundaries.lat_min, boundaries.lat_max)).sel(
+                                  lon=slice(boundaries.lon_min, boundaries.lon_max))
         
         return dataset_ill
 
-    def parquet(self, dataset, filename):
+    def parquet(self, dataset, filename, geometry='point'):
         """
         Sends dataset to a GeoParquet file
 
         Input:
             - dataset (Dataset) - An xarray dataset with a lat and a lon coordinate
             - filename (string) - File to save GeoParquet to
+            - geometry (string) - "point" for the grid cell centers, "cell" for the grid cell boxes
+                    (longitudes of the boxes are on the -180-180 scale)
 
         No output, but saves a file at filename
         """
         dataframe = dataset.to_dataframe()
         dataframe_reset = dataframe.reset_index()
+        if geometry == 'cell':
+            # Same (cached) cell boxes as the county aggregation
+            cells = cell_polygons(dataset.lat.values, dataset.lon.values, "NAD83")
+            cell_index = (pd.Index(dataset.lat.values).get_indexer(dataframe_reset.lat) * dataset.lon.size + 
+                          pd.Index(dataset.lon.values).get_indexer(dataframe_reset.lon))
+            geom = cells.values[cell_index]
+        elif geometry == 'point':
+            geom = geopandas.points_from_xy(dataframe_reset.lon, dataframe_reset.lat)
+        else:
+            raise ValueError("geometry must be 'point' or 'cell'")
         gdf = geopandas.GeoDataFrame(
                 dataframe_reset, 
-                geometry=geopandas.points_from_xy(dataframe_reset.lon, dataframe_reset.lat), 
+                geometry=geom, 
                 crs="NAD83",
                 )
 
@@ -200,6 +265,3 @@ class OpenLocaCat:
         del gdf['lon']
         
         gdf.to_parquet(filename)
-
-
-    
\ No newline at end of file
@@ -3,69 +3,476 @@ import glob
 import pandas as pd
 import os
 import argparse
-from datetime import date
+import functools
+import hashlib
+import json
+import threading
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from ERA5.era5il_models import IL_boundaries
+from calculations.file_years import prune_files
+from calculations.calendars import normalize_time
+from calculations import encoding
+from calculations.ensemble import stack_runs
 
 
-def loca2_processing(scenario, variable, year_start, year_end):
+CATALOG_PATH = '/data/keeling/a/cristi/a/downscaled_data/LOCA2/LOCA2_catalog.csv'
+CATALOG_KEYS = ['variable', 'scheme', 'model', 'experiment_id']
+# Parquet copies of catalogs, per user (location can be moved with CLIMATE_MAP_CACHE)
+CATALOG_CACHE = Path(os.environ.get('CLIMATE_MAP_CACHE', Path.home() / '.cache' / 'climate_map')) / 'catalogs'
+# Record of the members completely written to an incremental store
+MANIFEST = 'manifest.json'
+
+# One year of the whole grid per chunk, for the members of an incremental store (and LOCA2_zarr.CHUNKS)
+MEMBER_CHUNKS = {'time': 365, 'lat': -1, 'lon': -1}
+
+# netCDF4/HDF5 isn't thread safe: files are opened by one thread at a time
+_open_lock = threading.Lock()
+
+
+class CatalogIndex:
+    def __init__(self, catalog):
+        """
+        Index of the LOCA2 catalog for constant time lookups of file lists
+
+        Input:
+            - catalog (DataFrame) - LOCA2 catalog with variable, scheme, model, experiment_id and path columns
+        """
+        catalog = catalog.reset_index()
+        # Model order of the catalog, kept so datasets get concatenated the same way every time
+        self.model_list = list(catalog['model'].unique())
+        self.files = {key: list(group) for key, group in 
+                      catalog.groupby(CATALOG_KEYS, sort=False)['path']}
+        self.members = {}
+        for variable, scheme, model, member in self.files:
+            self.members.setdefault((variable, scheme, model), []).append(member)
+
+    def models(self):
+        """
+        All models in the catalog
+        
+        """
+        return self.model_list
+
+    def member_ids(self, variable, scheme, model):
+        """
+        Ensemble members (i.e. r1i1p1f1, r2i1p1f1, etc.) available for a variable, scheme and model
+        
+        """
+        return self.members.get((variable, scheme, model), [])
+
+    def paths(self, variable, scheme, model, member):
+        """
+        Files of one ensemble member
+        
+        """
+        return self.files.get((variable, scheme, model, member), [])
+
+
+
+@functools.lru_cache(maxsize=None)
+def load_catalog(catalog_path=CATALOG_PATH, cache_dir=CATALOG_CACHE):
     """
+    Loads the LOCA2 catalog once per process. A Parquet copy indexed by (variable, scheme, model, 
+    experiment_id) is kept in a per-user cache directory and used as long as it is newer than the CSV.
+
+    Input:
+     - catalog_path (str) - Location of LOCA2_catalog.csv
+     - cache_dir (str) - Directory holding the Parquet copies
+    Output:
+     - index (CatalogIndex) - Lookups of file lists by variable, scheme, model and member
     
-    Code to process LOCA2 Datasets for use over Illinois 
+    """
+    key = hashlib.sha1(os.path.abspath(catalog_path).encode()).hexdigest()[:16]
+    parquet_path = Path(cache_dir) / (os.path.splitext(os.path.basename(catalog_path))[0] + '_' + key + '.parquet')
+
+    catalog = None
+    if parquet_path.exists() and parquet_path.stat().st_mtime >= os.path.getmtime(catalog_path):
+        try:
+            catalog = pd.read_parquet(parquet_path)
+        except Exception: # Unreadable copy (e.g. an old partial write), rebuilt from the CSV
+            catalog = None
+    if catalog is None:
+        catalog = pd.read_csv(catalog_path).set_index(CATALOG_KEYS)
+        tmp = parquet_path.with_name(parquet_path.name + '.' + str(os.getpid()) + '.tmp')
+        try:
+            parquet_path.parent.mkdir(parents=True, exist_ok=True)
+            catalog.to_parquet(tmp)
+            os.replace(tmp, parquet_path) # Atomic, so other processes never read a half written file
+        except (OSError, ImportError):
+            tmp.unlink(missing_ok=True) # Unwritable cache or no Parquet engine, the CSV still works
     
+    return CatalogIndex(catalog)
+
+
+def subset_boundaries(dataset, boundaries=IL_boundaries):
+    """
+    Cuts a dataset down to a bounding box. Used as the preprocess step of open_mfdataset so 
+    every file is subset as soon as it is opened.
+
+    Inputs:
+     - dataset (Dataset) - Dataset with lat and lon (0-360) coordinates
+     - boundaries (GeographicBoundaries) - Bounding box to keep
+    Output:
+     - dataset (Dataset) - Dataset within the bounding box
     
+    """
+    return dataset.sel(lat=slice(boundaries.lat_min, boundaries.lat_max), 
+                       lon=slice(boundaries.lon_min, boundaries.lon_max))
+
+
+
+def preprocess_file(dataset, boundaries=IL_boundaries, leap_day='drop'):
+    """
+    Cuts a file to the bounding box and decodes its (model calendar) times to real dates. 
+    Used as the preprocess step of open_mfdataset.
+
+    Inputs:
+     - dataset (Dataset) - One file, opened with decode_times=False
+     - boundaries (GeographicBoundaries) - Bounding box to pull
+     - leap_day (str) - drop, fill, interpolate (see calculations.calendars.normalize_time)
+    Output:
+     - dataset (Dataset) - Subset with datetime64 times
+    
+    """
+    return normalize_time(subset_boundaries(dataset, boundaries), leap_day=leap_day)
+
+
+
+def open_member(mem_data, variable, year_start, year_end, boundaries=IL_boundaries, leap_day='drop'):
+    """
+    Opens the files of one ensemble member
+
+    Inputs:
+     - mem_data (list) - Files of the ensemble member
+     - variable (str) - pr, tasmax, tasmin
+     - year_start (int) - First year you'd like to request
+     - year_end (int) - Last year you'd like to request (inclusive)
+     - boundaries (GeographicBoundaries) - Bounding box to cut each file to when it is opened
+     - leap_day (str) - What to do with days missing from the model calendar (drop, fill, interpolate)
+    Output:
+     - dataset_mem (Dataset or None) - Ensemble member's data, None if it doesn't contain variable
+    
+    """
+    # Times are decoded from their raw offsets with lookup tables instead of cftime objects,
+    # and end up on real dates so that datasets from different models cooperate.
+    # Opens from several threads at once crash netCDF4, so they are serialized (and not parallel)
+    with _open_lock:
+        dataset_mem = xr.open_mfdataset(mem_data, combine="by_coords", decode_times=False, parallel=False,
+                                        preprocess=functools.partial(preprocess_file, boundaries=boundaries, 
+                                                                     leap_day=leap_day))
+    if variable not in dataset_mem.variables:
+        return None
+    dataset_mem = dataset_mem.sel(time=slice(str(year_start), str(year_end)))
+    return dataset_mem
+
+
+
+def member_tasks(scenario, variable, year_start, year_end):
+    """
+    Lists the ensemble members to open, in catalog order
+
     Inputs:
      - scenario (str) - historical, ssp245, ssp370, ssp585
-     - variable (str) - pr (Precipitation), tasmax (Maximum surface air temp.), tasmin (Minimum surface air temp.)
+     - variable (str) - pr, tasmax, tasmin
      - year_start (int) - First year you'd like to request
      - year_end (int) - Last year you'd like to request (inclusive)
-    Outputs:
-     - dataset (Dataset) - Contains data of given variable in Illinois within the designated 
+    Output:
+     - tasks (list) - (model, member ID, files) of every member with files in the requested years
     
     """
     # Locating the catalog
-    catalog = pd.read_csv('/data/keeling/a/cristi/a/downscaled_data/LOCA2/LOCA2_catalog.csv')
+    catalog = load_catalog()
 
-    list_dataset_model = []
-    for model in catalog.model.unique(): 
-        print(model)
-        # Looking to see if file exists for specified requirements
-        cat_pull = catalog.loc[(catalog['variable']==variable) & (catalog['model']==model) & (catalog['scheme']==scenario)]
+    tasks = []
+    for model in catalog.models(): 
         # For each ensemble member (i.e. r1i1p1f1, r2i1p1f1, etc.)
-        list_dataset_mem = []
-        i = 0
-        for mem in cat_pull.experiment_id.unique(): 
-            mem_data = cat_pull.loc[(cat_pull['experiment_id']==mem)]['path'].to_list()
+        for mem in catalog.member_ids(variable, scenario, model): 
+            # Only the files overlapping the requested years get opened
+            mem_data = prune_files(catalog.paths(variable, scenario, model, mem), year_start, year_end)
+            if len(mem_data) == 0:
+                continue
             if model=='CanESM5' and mem=='r3i1p1f1' and scenario=='ssp585' and variable=='pr':
                 continue
-            dataset_mem = xr.open_mfdataset(mem_data, combine="by_coords", use_cftime=True) # Opening datasets
-            if variable not in dataset_mem.variables:
+            tasks.append((model, mem, mem_data))
+    return tasks
+
+
+
+def iter_members(tasks, variable, year_start, year_end, boundaries=IL_boundaries, max_workers=8, leap_day='drop'):
+    """
+    Opens ensemble members in a pool of threads and yields them in task order as they become available.
+    The netCDF opens themselves take turns (see open_member), but the next members get opened while
+    the ones already yielded are being used.
+
+    Inputs:
+     - tasks (list) - (model, member ID, files) from member_tasks
+     - variable (str) - pr, tasmax, tasmin
+     - year_start (int) - First year you'd like to request
+     - year_end (int) - Last year you'd like to request (inclusive)
+     - boundaries (GeographicBoundaries) - Bounding box to cut each file to when it is opened
+     - max_workers (int) - Number of members opened ahead
+     - leap_day (str) - What to do with days missing from the model calendar (drop, fill, interpolate)
+    Output:
+     - (model, mem, dataset_mem) for every member containing variable
+    
+    """
+    # Opening the next members overlaps with whatever is done with the previous ones
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = [pool.submit(open_member, mem_data, variable, year_start, year_end, boundaries, leap_day) 
+                   for _, _, mem_data in tasks]
+
+        for (model, mem, _), future in zip(tasks, futures):
+            dataset_mem = future.result()
+            if dataset_mem is None:
                 continue
-            # Assigning new time coordinates so that datasets from different models cooperate
-            dataset_mem = dataset_mem.assign(time=pd.date_range(start=(str(dataset_mem.time[0].values).split(' ')[0]),
-                                            freq='D',
-                                            periods=len(dataset_mem.time))).sel(time=slice(str(year_start), str(year_end)))
-            # Assigning ensemble member name
-            dataset_mem['ens_mem'] = i 
-            list_dataset_mem.append(dataset_mem)
-            i += 1
-        if len(list_dataset_mem) == 0:
-            continue
-        # If only one dataset, assign model to that dataset
-        elif len(list_dataset_mem) == 1: 
-            dataset_model = list_dataset_mem[0]
-            dataset_model = dataset_model.expand_dims(dim={'ens_mem':1})
-            dataset_model = dataset_model.assign_coords()
-        else: 
-            dataset_model = xr.concat(list_dataset_mem, dim='ens_mem', coords='minimal', compat='override')
-        # Assign model name
-        dataset_model['model'] = model
-        # Picking out the Illinois region
-        dataset_model = dataset_model.sel(lat=slice(36,43.5)).sel(lon=slice(267.2,274))
-        list_dataset_model.append(dataset_model)
+            print(model, mem)
+            yield model, mem, dataset_mem
+
+
+
+def load_members(scenario, variable, year_start, year_end, boundaries=IL_boundaries, max_workers=8, leap_day='drop'):
+    """
+    Opens every model's ensemble members (see iter_members)
+
+    Inputs:
+     - scenario (str) - historical, ssp245, ssp370, ssp585
+     - variable (str) - pr, tasmax, tasmin
+     - year_start (int) - First year you'd like to request
+     - year_end (int) - Last year you'd like to request (inclusive)
+     - boundaries (GeographicBoundaries) - Bounding box to cut each file to when it is opened
+     - max_workers (int) - Number of members opened ahead
+     - leap_day (str) - What to do with days missing from the model calendar (drop, fill, interpolate)
+    Output:
+     - members (dict) - Model name to list of (member ID, Dataset), in catalog order
+    
+    """
+    tasks = member_tasks(scenario, variable, year_start, year_end)
+
+    members = {}
+    for model, mem, dataset_mem in iter_members(tasks, variable, year_start, year_end, boundaries, 
+                                                max_workers, leap_day):
+        members.setdefault(model, []).append((mem, dataset_mem))
+    
+    return members
+
+
+
+def combine_members(list_dataset_mem, model):
+    """
+    Puts a model's ensemble members together along an "ens_mem" dimension
+
+    Inputs:
+     - list_dataset_mem (list) - Datasets of each ensemble member
+     - model (str) - Model name
+    Output:
+     - dataset_model (Dataset) - Model's data with ens_mem and model coordinates
+    
+    """
+    for i, dataset_mem in enumerate(list_dataset_mem):
+        # Assigning ensemble member name
+        dataset_mem['ens_mem'] = i 
+    # If only one dataset, assign model to that dataset
+    if len(list_dataset_mem) == 1: 
+        dataset_model = list_dataset_mem[0]
+        dataset_model = dataset_model.expand_dims(dim={'ens_mem':1})
+        dataset_model = dataset_model.assign_coords()
+    else: 
+        dataset_model = xr.concat(list_dataset_mem, dim='ens_mem', coords='minimal', compat='override')
+    # Assign model name
+    dataset_model['model'] = model
+    return dataset_model
+
+
+
+def open_loca2_store(store, scenario, variable, year_start, year_end, boundaries=IL_boundaries):
+    """
+    Reads LOCA2 data from a Zarr store written by LOCA2_zarr.py instead of the raw netCDF files
+
+    Inputs:
+     - store (str) - Location of the Zarr store
+     - scenario (str) - historical, ssp245, ssp370, ssp585
+     - variable (str) - pr, tasmax, tasmin
+     - year_start (int) - First year you'd like to request
+     - year_end (int) - Last year you'd like to request (inclusive)
+     - boundaries (GeographicBoundaries) - Bounding box to pull
+    Output:
+     - dataset (Dataset) - Same layout as loca2_processing (model, ens_mem, time, lat, lon), loaded lazily
+    
+    """
+    dataset = xr.open_zarr(store, group=scenario + '/' + variable, consolidated=True)
+    dataset = subset_boundaries(dataset, boundaries).sel(time=slice(str(year_start), str(year_end)))
+    return dataset
+
+
+
+def loca2_processing(scenario, variable, year_start, year_end, boundaries=IL_boundaries, max_workers=8, store=None,
+                     leap_day='drop', ragged=False):
+    """
+    
+    Code to process LOCA2 Datasets for use over Illinois 
+    
+    
+    Inputs:
+     - scenario (str) - historical, ssp245, ssp370, ssp585
+     - variable (str) - pr (Precipitation), tasmax (Maximum surface air temp.), tasmin (Minimum surface air temp.)
+     - year_start (int) - First year you'd like to request
+     - year_end (int) - Last year you'd like to request (inclusive)
+     - boundaries (GeographicBoundaries) - Bounding box to cut each file to when it is opened (default: Illinois)
+     - max_workers (int) - Number of ensemble members opened ahead
+     - store (str) - Zarr store made by LOCA2_zarr.py. If given, data is read from it instead of the raw files
+     - leap_day (str) - What to do with days missing from a model's calendar: drop them, fill them with NaN
+                        or interpolate them (noleap models have no Feb 29, 360_day models skip 5-6 days a year)
+     - ragged (bool) - If True, members are stacked along a "run" dimension indexed by (model, ens_mem), holding 
+                        only the members that exist, instead of padding every model with NaN to the largest 
+                        member count. The member IDs are kept in a "member_id" coordinate along run.
+                        Only applies when reading the raw files (not a store).
+    Outputs:
+     - dataset (Dataset) - Contains data of given variable in Illinois within the designated 
+    
+    """
+    if store is not None:
+        return open_loca2_store(store, scenario, variable, year_start, year_end, boundaries)
+
+    members = load_members(scenario, variable, year_start, year_end, boundaries, max_workers, leap_day)
+
+    if ragged:
+        runs = [((model, i), dataset_mem) for model in members 
+                for i, (_, dataset_mem) in enumerate(members[model])]
+        dataset = stack_runs(runs, levels=('model', 'ens_mem'))
+        member_ids = [mem for model in members for mem, _ in members[model]]
+        return dataset.assign_coords(member_id=('run', member_ids))
+
+    list_dataset_model = []
+    for model in members: 
+        list_dataset_mem = [dataset_mem for _, dataset_mem in members[model]]
+        list_dataset_model.append(combine_members(list_dataset_mem, model))
     # Appending all the datasets for each model together
     dataset = xr.concat(list_dataset_model, dim='model')
     return dataset
 
+
+
+def output_name(scenario, variable, year_start, year_end):
+    """
+    Name of the processed output, the same every time the same request is run
+    
+    """
+    return 'LOCA2_IL_' + variable + '_' + scenario + '_' + str(year_start) + '-' + str(year_end)
+
+
+
+def read_manifest(store):
+    """
+    Reads the manifest of an incremental store (empty if the store hasn't been started)
+    
+    """
+    path = os.path.join(store, MANIFEST)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+
+def write_manifest(store, manifest):
+    """
+    Writes the manifest of an incremental store
+    
+    """
+    path = os.path.join(store, MANIFEST)
+    tmp = path + '.' + str(os.getpid()) + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp, path) # Atomic, so an interruption never leaves a broken manifest
+
+
+
+def incremental_loca2(store, scenario, variable, year_start, year_end, boundaries=IL_boundaries, max_workers=8,
+                      leap_day='drop'):
+    """
+    Processes LOCA2 data one ensemble member at a time into a Zarr store. Each member is written to 
+    its own group ("model/member") as soon as it is opened, and recorded in the store's manifest once 
+    written. Running it again on the same store skips the members already in the manifest, so an 
+    interrupted run picks up where it stopped. Read the store back with open_incremental.
+
+    Inputs:
+     - store (str) - Location of the Zarr store
+     - scenario (str) - historical, ssp245, ssp370, ssp585
+     - variable (str) - pr, tasmax, tasmin
+     - year_start (int) - First year you'd like to request
+     - year_end (int) - Last year you'd like to request (inclusive)
+     - boundaries (GeographicBoundaries) - Bounding box to cut each file to when it is opened (default: Illinois)
+     - max_workers (int) - Number of ensemble members opened ahead
+     - leap_day (str) - What to do with days missing from a model's calendar (drop, fill, interpolate)
+    Output:
+     - store (str) - Location of the Zarr store
+    
+    """
+    request = {'scenario': scenario, 'variable': variable, 'year_start': year_start, 'year_end': year_end,
+               'boundaries': [boundaries.lon_min, boundaries.lon_max, boundaries.lat_min, boundaries.lat_max], 'leap_day': leap_day}
+
+    manifest = read_manifest(store)
+    if manifest and manifest['request'] != request:
+        raise ValueError(store + " was started for a different request: " + str(manifest['request']))
+
+    tasks = member_tasks(scenario, variable, year_start, year_end)
+    completed = set(manifest.get('completed', []))
+    manifest = {'request': request,
+                'order': [model + '/' + mem for model, mem, _ in tasks], # Catalog order, for reading back
+                'completed': list(manifest.get('completed', []))}
+    os.makedirs(store, exist_ok=True)
+    write_manifest(store, manifest)
+
+    remaining = [task for task in tasks if task[0] + '/' + task[1] not in completed]
+    print(str(len(tasks) - len(remaining)) + ' of ' + str(len(tasks)) + ' members already done')
+
+    for model, mem, dataset_mem in iter_members(remaining, variable, year_start, year_end, boundaries, 
+                                                max_workers, leap_day):
+        key = model + '/' + mem
+        for var in dataset_mem.variables:
+            # Encoding of the source netCDFs doesn't apply to Zarr
+            dataset_mem[var].encoding = {}
+        # Zarr needs uniform chunks, the files of a member don't all hold the same number of days
+        dataset_mem = dataset_mem.chunk(MEMBER_CHUNKS)
+        # Overwrites whatever an interrupted write left behind
+        dataset_mem.to_zarr(store, group=key, mode='w', consolidated=True, zarr_format=2)
+        manifest['completed'].append(key)
+        write_manifest(store, manifest)
+
+    print('Dataset saved to ' + store)
+    return store
+
+
+
+def open_incremental(store):
+    """
+    Opens a store written by incremental_loca2, with the same layout as loca2_processing
+    (model, ens_mem, time, lat, lon). Only members that were completely written are included.
+
+    Input:
+     - store (str) - Location of the Zarr store
+    Output:
+     - dataset (Dataset) - LOCA2 data, loaded lazily
     
+    """
+    manifest = read_manifest(store)
+    completed = set(manifest.get('completed', []))
+
+    members = {}
+    for key in manifest.get('order', []):
+        if key in completed:
+            model = key.split('/')[0]
+            members.setdefault(model, []).append(xr.open_zarr(store, group=key, consolidated=True))
+    if len(members) == 0:
+        raise ValueError("No completed members in " + store)
+
+    list_dataset_model = [combine_members(list_dataset_mem, model) for model, list_dataset_mem in members.items()]
+    dataset = xr.concat(list_dataset_model, dim='model')
+    return dataset
+
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--scenario", required=True, type=str)
@@ -73,6 +480,17 @@ if __name__ == "__main__":
     parser.add_argument("--year_start", required=True, type=int)
     parser.add_argument("--year_end", required=True, type=int)
     parser.add_argument("--out_path", required=True, type=str)
+    parser.add_argument("--max_workers", required=False, type=int, default=8)
+    parser.add_argument("--store", required=False, type=str, default=None)
+    parser.add_argument("--leap_day", required=False, type=str, default='drop', choices=['drop', 'fill', 'interpolate'])
+    parser.add_argument("--incremental", action='store_true',
+                        help="Write each member to a Zarr store as it is processed, resuming if the store exists")
+    parser.add_argument("--encoding", required=False, type=str, default=None, choices=encoding.PROFILES,
+                        help="Encoding profile of the netCDF output (default: float32)")
+    parser.add_argument("--layout", required=False, type=str, default=None, choices=encoding.LAYOUTS,
+                        help="Chunk layout of the netCDF output (default: time)")
+    parser.add_argument("--ragged", action='store_true', 
+                        help="Stack members along a run dimension instead of padding models to the same member count")
     args = parser.parse_args()
     
     scenario = args.scenario
@@ -80,11 +498,21 @@ if __name__ == "__main__":
     year_start = args.year_start
     year_end = args.year_end
     out_path = args.out_path
-    dataset = loca2_processing(scenario, variable, year_start, year_end)
-          
-    # Saving the dataset
-    output_file = (out_path + '/LOCA2_IL_' + variable + '_' + scenario + '_' + str(year_start) + '-' + str(year_end) + '_' + 
-                   str(date.today()) + '.nc')
-    dataset.to_netcdf(output_file)
-    print('Dataset saved to ' + output_file)
-
+    if args.incremental and (args.encoding is not None or args.layout is not None or args.ragged):
+        parser.error("--encoding, --layout and --ragged only apply to the netCDF output, not --incremental")
+    if args.incremental:
+        store = os.path.join(out_path, output_name(scenario, variable, year_start, year_end) + '.zarr')
+        incremental_loca2(store, scenario, variable, year_start, year_end, max_workers=args.max_workers,
+                          leap_day=args.leap_day)
+    else:
+        dataset = loca2_processing(scenario, variable, year_start, year_end, max_workers=args.max_workers, 
+                                   store=args.store, leap_day=args.leap_day, ragged=args.ragged)
+              
+        # Saving the dataset
+        output_file = os.path.join(out_path, output_name(scenario, variable, year_start, year_end) + '.nc')
+        if args.ragged:
+            # netCDF can't hold a MultiIndex, model and ens_mem are saved as coordinates along run
+            # (restore it with dataset.set_index(run=['model', 'ens_mem']))
+            dataset = dataset.reset_index('run')
+        encoding.to_netcdf(dataset, output_file, profile=args.encoding or 'float32', layout=args.layout or 'time')
+        print('Dataset saved to ' + output_file)
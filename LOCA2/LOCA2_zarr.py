@@ -0,0 +1,73 @@
+import argparse
+
+import numcodecs
+import numpy as np
+
+from ERA5.era5il_models import IL_boundaries
+from LOCA2.LOCA2_processor import MEMBER_CHUNKS, load_catalog, loca2_processing
+
+
+# Years available in each scenario
+SCENARIO_YEARS = {'historical': (1950, 2014), 'ssp245': (2015, 2100), 'ssp370': (2015, 2100), 'ssp585': (2015, 2100)}
+# One year of the whole Illinois grid per chunk, for one model and member
+CHUNKS = {'model': 1, 'ens_mem': 1, **MEMBER_CHUNKS}
+
+
+def loca2_to_zarr(store, scenarios=None, variables=None, boundaries=IL_boundaries, max_workers=8):
+    """
+    Converts the raw LOCA2 netCDF files to a single consolidated, compressed Zarr store for the 
+    Illinois subset. Each scenario and variable is a group ("ssp245/tasmax", ...) with the 
+    dimensions model, ens_mem, time, lat and lon. Read it back with loca2_processing(..., store=store).
+
+    Inputs:
+     - store (str) - Location of the Zarr store to write
+     - scenarios (list) - Scenarios to convert (default: all of historical, ssp245, ssp370, ssp585)
+     - variables (list) - Variables to convert (default: pr, tasmax, tasmin)
+     - boundaries (GeographicBoundaries) - Bounding box to keep (default: Illinois)
+     - max_workers (int) - Number of ensemble members opened at the same time
+    Output:
+     - None, writes the store
+
+    """
+    if scenarios is None:
+        scenarios = list(SCENARIO_YEARS)
+    if variables is None:
+        variables = ['pr', 'tasmax', 'tasmin']
+
+    load_catalog() # The catalog is read once and reused for every group
+
+    compressor = numcodecs.Blosc(cname='zstd', clevel=5, shuffle=numcodecs.Blosc.BITSHUFFLE)
+    for scenario in scenarios:
+        year_start, year_end = SCENARIO_YEARS[scenario]
+        for variable in variables:
+            print(scenario, variable)
+            dataset = loca2_processing(scenario, variable, year_start, year_end, boundaries, max_workers)
+            dataset = dataset.chunk(CHUNKS)
+
+            # Dropping the encoding of the source netCDFs, which doesn't apply to Zarr
+            for var in dataset.variables:
+                dataset[var].encoding = {}
+            # Only the climate fields go to float32, bounds and integer variables keep their dtype
+            encoding = {}
+            for var in dataset.data_vars:
+                encoding[var] = {'compressor': compressor}
+                if (np.issubdtype(dataset[var].dtype, np.floating) and 
+                    'lat' in dataset[var].dims and 'lon' in dataset[var].dims):
+                    encoding[var]['dtype'] = 'float32'
+
+            dataset.to_zarr(store, group=scenario + '/' + variable, mode='w', encoding=encoding,
+                            consolidated=True, zarr_format=2) # Consolidated metadata, so opening a group is one read
+
+    print('Store saved to ' + store)
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--store", required=True, type=str)
+    parser.add_argument("--scenarios", required=False, type=str, nargs='+', default=None)
+    parser.add_argument("--variables", required=False, type=str, nargs='+', default=None)
+    parser.add_argument("--max_workers", required=False, type=int, default=8)
+    args = parser.parse_args()
+
+    loca2_to_zarr(args.store, args.scenarios, args.variables, max_workers=args.max_workers)
@@ -4,10 +4,14 @@ import xee
 import xarray as xr
 import glob
 import argparse
+import functools
 from calculations.calculations import vapor_pressure
+from calculations.file_years import prune_files
+from calculations.calendars import normalize_time
+from calculations import encoding
 
 
-def nexgddpcmip6_processing(scenario, variable, year_start, year_end):
+def nexgddpcmip6_processing(scenario, variable, year_start, year_end, leap_day='drop'):
     """
     Code to process NEX-GDDP-CMIP6 Data from the Google Cloud
     https://developers.google.com/earth-engine/datasets/catalog/NASA_GDDP-CMIP6#bands
@@ -20,6 +24,8 @@ def nexgddpcmip6_processing(scenario, variable, year_start, year_end):
                                 Note: ssp370 may not be available for many variables
     - year_start (int) - First year you want
     - year_end (int) - Last year you want (inclusive)
+    - leap_day (str) - What to do with days missing from a model's calendar (ssp370 files only): 
+                        drop them, fill them with NaN or interpolate them (see calculations.calendars)
     Outputs:
     - None, saves a netCDF4 file
     
@@ -54,17 +60,18 @@ def nexgddpcmip6_processing(scenario, variable, year_start, year_end):
             for var in variable:
                 var_find = glob.glob(base_directory + model + '/ssp370/*/' + var + '/' 
                                               + var + '_day_' + model +  '_ssp370_*')
+                # Only the yearly files overlapping the requested years get opened
+                var_find = prune_files(sorted(var_find), year_start, year_end)
                 if len(var_find) > 0:
                     nexgddp_filtered += var_find
                 else:
                     print(model, "doesn't have sufficient variables")
                     var_counter = False
             if var_counter == True: 
-                filtered_dataset = xr.open_mfdataset(nexgddp_filtered,combine="by_coords", use_cftime=True) # Opening datasets
-                filtered_dataset = filtered_dataset.assign(time=pd.date_range(start=
-                                                                              (str(filtered_dataset.time[0].values).split(' ')[0]),
-                                            freq='D',
-                                            periods=len(filtered_dataset.time))).sel(time=slice(str(year_start), str(year_end)))
+                # Times decoded to real dates with lookup tables, so that models with different calendars cooperate
+                filtered_dataset = xr.open_mfdataset(nexgddp_filtered,combine="by_coords", decode_times=False,
+                                                     preprocess=functools.partial(normalize_time, leap_day=leap_day)) # Opening datasets
+                filtered_dataset = filtered_dataset.sel(time=slice(str(year_start), str(year_end)))
                 filtered_dataset['model'] = model
                 print(model)
                 filtered_dataset.load()
@@ -128,6 +135,9 @@ if __name__ == "__main__":
     parser.add_argument("--scenario", required=True, type=str)
     #parser.add_argument("--project", required=False, type=str)
     parser.add_argument("--out_path", required=True, type=str)
+    parser.add_argument("--encoding", required=False, type=str, default='float32', choices=encoding.PROFILES)
+    parser.add_argument("--layout", required=False, type=str, default='time', choices=encoding.LAYOUTS)
+    parser.add_argument("--leap_day", required=False, type=str, default='drop', choices=['drop', 'fill', 'interpolate'])
     args = parser.parse_args()
     
     year_start = args.year_start
@@ -138,11 +148,11 @@ if __name__ == "__main__":
     out_path = args.out_path
     
     #if not project:
-    dataset = nexgddpcmip6_processing(scenario, variable, year_start, year_end)
+    dataset = nexgddpcmip6_processing(scenario, variable, year_start, year_end, leap_day=args.leap_day)
     #else:
     #    nexgddpcmip6_processing(year_start, year_end, variable, scenario, out_path, project)
         
     # Saving the dataset
     output_file = out_path + '/NEX-GDDP-CMIP6_IL_' + variable + '_' + scenario + '_' + str(year_start) + '-' + str(year_end) + '.nc'
-    dataset.to_netcdf(output_file)
+    encoding.to_netcdf(dataset, output_file, profile=args.encoding, layout=args.layout)
     print('Dataset saved to ' + output_file)
\ No newline at end of file
@@ -1,175 +1,753 @@
-def weighted_aggregation(shapes, band, shapefile, crs):
+import collections
+import hashlib
+import multiprocessing
+import os
+import shutil
+from multiprocessing import shared_memory
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyproj
+import rioxarray
+import scipy.sparse
+import shapely
+import xarray as xr
+
+from calculations import weight_cache
+
+
+def agg_call(dataset_io, shapefile_path, crs, name_col='NAME', cache_dir=weight_cache.CACHE_DIR, processes=None):
     """
-    Function to do weighted aggregation over counties
+    Aggregates a gridded DataArray over counties, in memory (no GeoTIFF is written)
 
     Inputs:
-        shapes - (list) Polygons
-        band - (int) Band you want (usually time step)
-        shapefile - (Geodataframe) Shapefile to fit dataset to 
+        dataset_io - (DataArray) Data with lat, lon and time dimensions (numpy or dask backed)
+        shapefile_path - (str) Path to the shapefile or GeoJSON with the counties
+        crs - (str) Coordinate reference system of the data
+        name_col - (str) Column of the shapefile with the county names
+        cache_dir - (str) Directory of the weight cache (None to skip the cache)
+        processes - (int) If given, timesteps are aggregated by this many worker processes 
+                    (see parallel_aggregate_counties)
     Outputs:
-        geoframe - (GeoDataFrame) gdf of the original data and geometries
-        shapefile - (GeoDataFrame) Data aggregated to shapefile
+        shp_fuse - (GeoDataFrame) County name, weighted value, geometry and time for every timestep
+
+    """
+    print(dataset_io.shape)
+    # Weights only depend on the grid and the counties, so they are computed (or loaded) once
+    weights = load_county_weights(dataset_io['lat'].values, dataset_io['lon'].values, shapefile_path, crs,
+                                  name_col=name_col, cache_dir=cache_dir)
+    if processes is None:
+        aggregated = aggregate_counties(dataset_io, weights)
+    else:
+        aggregated = parallel_aggregate_counties(dataset_io, weights, processes=processes)
+    
+    # Long format table, one row per county per timestep
+    frame = aggregated.transpose('time', ...).to_series().rename('weight_vals').reset_index()
+    frame = frame.rename(columns={'county': name_col})
+    frame['time'] = frame['time'].astype(str)
+    
+    # Opening shapefile
+    shapefile = gpd.read_file(shapefile_path)[[name_col, 'geometry']]
+    shp_fuse = gpd.GeoDataFrame(pd.merge(frame, shapefile, on=name_col, how='left'), 
+                                geometry='geometry', crs=shapefile.crs)
+    return shp_fuse[[name_col, 'weight_vals', 'geometry', 'time'] + 
+                    [col for col in frame.columns if col not in (name_col, 'weight_vals', 'time')]]
+
+
+
+class CountyWeights:
+    def __init__(self, matrix, names, lat, lon):
+        """
+        Grid cell to county weights, computed once per grid and shapefile
+
+        Inputs:
+            matrix - (csr_matrix) Proportion of each grid cell's area (columns, lat-major order) 
+                        that falls in each county (rows)
+            names - (array) County names, one per row of matrix
+            lat - (array) Latitudes of the grid cell centers
+            lon - (array) Longitudes of the grid cell centers
+        """
+        self.matrix = scipy.sparse.csr_matrix(matrix)
+        self.names = np.asarray(names)
+        self.lat = np.asarray(lat)
+        self.lon = np.asarray(lon)
+
+    @property
+    def shape(self):
+        """
+        Shape of the grid (lat, lon) the weights were built for
+
+        """
+        return (self.lat.size, self.lon.size)
+
+
+
+def cell_edges(coord):
+    """
+    Calculates grid cell edges from grid cell centers
+
+    Input:
+        coord - (array) Cell centers along one axis (lat or lon)
+    Output:
+        edges - (array) Cell edges along that axis (one longer than coord)
+
+    """
+    coord = np.asarray(coord, dtype=float)
+    if coord.size == 1:
+        raise ValueError("Need at least two cell centers to find cell edges")
+    
+    mid = (coord[:-1] + coord[1:]) / 2 # Edges between cells
+    first = coord[0] - (mid[0] - coord[0]) # Outer edges mirror the nearest inner edge
+    last = coord[-1] + (coord[-1] - mid[-1])
+    
+    return np.concatenate([[first], mid, [last]])
+
 
+
+# Cell polygons of recently used grids, keyed by a hash of the grid
+_cell_polygon_cache = collections.OrderedDict()
+_CELL_POLYGON_CACHE_SIZE = 8
+
+def cell_polygons(lat, lon, crs):
     """
-    # Pulling out polygons
-    pol = list(shapes[band])
+    Creates one box per grid cell straight from the cell centers, ordered the same way as the 
+    flattened (lat, lon) grid. Results are kept in memory for the most recently used grids.
 
-    # Going from a list of GeoJSON-like dicts to a list of shapely geometry objects
-    geom = [shapely.geometry.shape(i[0]) for i in pol]
-    # Convert to a GeoSeries
-    geom = gpd.GeoSeries(geom, crs=crs)
+    Inputs:
+        lat - (array) Latitudes of the grid cell centers
+        lon - (array) Longitudes of the grid cell centers
+        crs - (str) Coordinate reference system of the grid
+    Output:
+        geom - (GeoSeries) Cell polygons, indexed by flattened cell number
 
+    """
+    lat = np.asarray(lat, dtype=float)
+    lon = np.asarray(lon, dtype=float)
+    
+    digest = hashlib.sha1()
+    for coord in (lat, lon):
+        digest.update(str(coord.shape).encode())
+        digest.update(np.ascontiguousarray(coord).tobytes())
+    digest.update(str(crs).encode())
+    key = digest.hexdigest()
+    if key in _cell_polygon_cache:
+        _cell_polygon_cache.move_to_end(key)
+        return _cell_polygon_cache[key]
+    
+    if pyproj.CRS.from_user_input(crs).is_geographic:
+        # Changing from 0-360 to -180-180 longitude scale to match the shapefiles
+        lon = np.where(lon > 180, lon - 360, lon)
+    
+    lat_edges = cell_edges(lat)
+    lon_edges = cell_edges(lon)
+    
+    # Lower and upper edges of every cell, in lat-major order like the flattened grid
+    lat_low, lon_low = np.meshgrid(np.minimum(lat_edges[:-1], lat_edges[1:]), 
+                                   np.minimum(lon_edges[:-1], lon_edges[1:]), indexing='ij')
+    lat_high, lon_high = np.meshgrid(np.maximum(lat_edges[:-1], lat_edges[1:]), 
+                                     np.maximum(lon_edges[:-1], lon_edges[1:]), indexing='ij')
+    boxes = shapely.box(lon_low.ravel(), lat_low.ravel(), lon_high.ravel(), lat_high.ravel())
+    
+    geom = gpd.GeoSeries(boxes, index=np.arange(boxes.size), crs=crs)
+    _cell_polygon_cache[key] = geom
+    if len(_cell_polygon_cache) > _CELL_POLYGON_CACHE_SIZE:
+        _cell_polygon_cache.popitem(last=False)
+    return geom
+
+
+
+def county_weights(lat, lon, shapefile, crs, name_col='NAME'):
+    """
+    Computes the area weight of every grid cell in every county with a single overlay
+
+    Inputs:
+        lat - (array) Latitudes of the grid cell centers
+        lon - (array) Longitudes of the grid cell centers
+        shapefile - (GeoDataFrame) Shapefile to fit dataset to
+        crs - (str) Coordinate reference system of the grid
+        name_col - (str) Column of the shapefile with the county names
+    Output:
+        weights - (CountyWeights) Sparse (county x grid cell) matrix of area proportions
+
+    """
+    geom = cell_polygons(lat, lon, crs)
     if crs != 'NAD83':
         # Convert coordinate reference system
         geom = geom.to_crs('NAD83')
     
-    # Extract values as well
-    values = [i[1] for i in pol]
-    values = pd.Series(values)
+    cells = gpd.GeoDataFrame({'cell': geom.index, 'geometry': geom.values}, crs=geom.crs)
+    cells['area'] = cells.area # Area of each square
+    
+    counties = shapefile[[name_col, 'geometry']].reset_index(drop=True)
+    counties['county'] = np.arange(len(counties))
+    if counties.crs is not None and counties.crs != cells.crs:
+        counties = counties.to_crs(cells.crs)
+    
+    shape_grid = cells.overlay(counties) # Overlaying the shapefile and the grid
+    area_prop = shape_grid.area / shape_grid['area'] # Proportional area of each square in each shape
+    
+    matrix = scipy.sparse.csr_matrix((area_prop.to_numpy(), 
+                                      (shape_grid['county'].to_numpy(), shape_grid['cell'].to_numpy())),
+                                     shape=(len(counties), np.size(lat) * np.size(lon)))
+    
+    return CountyWeights(matrix, counties[name_col].to_numpy(), lat, lon)
+
+
+
+def load_county_weights(lat, lon, shapefile_path, crs, name_col='NAME', 
+                        cache_dir=weight_cache.CACHE_DIR, max_bytes=weight_cache.MAX_BYTES):
+    """
+    Loads county weights from the on-disk cache, computing and caching them on a miss.
+    Cache hits never open the shapefile or do any overlays.
+
+    Inputs:
+        lat - (array) Latitudes of the grid cell centers
+        lon - (array) Longitudes of the grid cell centers
+        shapefile_path - (str) Path to the shapefile or GeoJSON with the counties
+        crs - (str) Coordinate reference system of the grid
+        name_col - (str) Column of the shapefile with the county names
+        cache_dir - (str) Directory holding the cache (None to skip the cache)
+        max_bytes - (int) Size cap of the cache, least recently used weights are evicted past it
+    Output:
+        weights - (CountyWeights) Sparse (county x grid cell) matrix of area proportions
 
-    # Create geodataframe
-    geoframe = gpd.GeoDataFrame({'value': values, 'geometry': geom})
+    """
+    if cache_dir is None:
+        return county_weights(lat, lon, gpd.read_file(shapefile_path), crs, name_col)
+    
+    key = weight_cache.weights_key(lat, lon, crs, shapefile_path, name_col)
+    cached = weight_cache.read_weights(key, cache_dir)
+    if cached is not None:
+        return CountyWeights(**cached)
     
-    geoframe['area'] = geoframe.area # Area of each square
-    shape_grid = geoframe.overlay(shapefile) # Overlaying the shapefile and the data
+    weights = county_weights(lat, lon, gpd.read_file(shapefile_path), crs, name_col)
+    weight_cache.write_weights(key, weights.matrix, weights.names, weights.lat, weights.lon, 
+                               cache_dir, max_bytes)
+    return weights
 
-    # Creating weighted averages
-    shape_grid['area_sub'] = shape_grid.area # Getting area of each square in each shape
-    shape_grid['area_prop'] = shape_grid['area_sub'] / shape_grid['area'] # Getting proportional area of each square in each shape
-    shape_grid['value_weight'] = shape_grid['value'] * shape_grid['area_prop'] # Getting proportional value based on area
 
-    var_sum_county = shape_grid.groupby('COUNTY_NAM')['value_weight'].sum().reset_index() # Summing data over counties
-    area_prop_county = shape_grid.groupby('COUNTY_NAM')['area_prop'].sum().reset_index() # Summing area proportions over counties
-    area_prop_county['weight_vals'] = var_sum_county['value_weight'] / area_prop_county['area_prop'] # Dividing total weighted data over weights
+def weighted_sums(values, matrix):
+    """
+    Area weighted sums and weight totals of flattened grids over counties. Missing cells are left
+    out of both.
+
+    Inputs:
+        values - (array) Array with flattened grid cells along the last axis
+        matrix - (csr_matrix) County x grid cell weights
+    Outputs:
+        sums - (array) Weighted sums with counties along the last axis
+        totals - (array) Weight totals with counties along the last axis (same shape as sums)
+
+    """
+    lead = values.shape[:-1]
+    flat = values.reshape(-1, values.shape[-1])
+    valid = ~np.isnan(flat)
     
-    shapefile = pd.merge(shapefile, area_prop_county[['COUNTY_NAM', 'weight_vals']], on='COUNTY_NAM', how='left') # Putting the GDF back together
+    # One matrix multiplication for every timestep at once
+    sums = (matrix @ np.where(valid, flat, 0).T).T
+    if valid.all():
+        totals = np.broadcast_to(np.asarray(matrix.sum(axis=1)).ravel(), sums.shape)
+    else:
+        totals = (matrix @ valid.T.astype(flat.dtype)).T
     
-    return geoframe, shapefile
+    shape = lead + (matrix.shape[0],)
+    return sums.reshape(shape), np.asarray(totals).reshape(shape)
 
 
 
-def agg_call(path_nc, path_tif, shapefile_path, crs):
+def weighted_mean(values, matrix):
+    """
+    Area weighted mean of flattened grids over counties. Missing cells are left out of both the
+    weighted sum and the weight total.
+
+    Inputs:
+        values - (array) Array with flattened grid cells along the last axis
+        matrix - (csr_matrix) County x grid cell weights
+    Output:
+        mean - (array) Array with counties along the last axis
+
+    """
+    sums, totals = weighted_sums(values, matrix)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = sums / totals
     
-    # Open as raster
-    dataset_io = rioxarray.open_rasterio(path_nc)
-    # Save as raster (tiff)
-    dataset_io.rio.to_raster(path_tif)
-    # Opening tiff raster
-    dataset_tif = rasterio.open(path_tif)
-    # Opening shapefile
-    shapefile = gpd.read_file(shapefile_path)
+    return mean
+
+
+
+def aggregate_counties(dataarray, weights, lat='lat', lon='lon'):
+    """
+    Aggregates a DataArray over counties with precomputed weights. Dask backed arrays stay lazy
+    and are aggregated chunk by chunk.
+
+    Inputs:
+        dataarray - (DataArray) Data with lat and lon dimensions (plus any others, e.g. time, model, ens_mem)
+        weights - (CountyWeights) Weights built for the same grid with county_weights
+        lat - (str) Name of the latitude dimension
+        lon - (str) Name of the longitude dimension
+    Output:
+        aggregated - (DataArray) Area weighted means with lat and lon replaced by a county dimension
+
+    """
+    if (dataarray.sizes[lat], dataarray.sizes[lon]) != weights.shape:
+        raise ValueError("Grid of the dataset does not match the grid of the weights")
+    
+    if dataarray.chunks is not None:
+        # Each chunk needs the whole grid for the matrix multiplication
+        dataarray = dataarray.chunk({lat: -1, lon: -1})
+    
+    def _aggregate(values):
+        values = values.reshape(values.shape[:-2] + (-1,))
+        return weighted_mean(values, weights.matrix)
+    
+    aggregated = xr.apply_ufunc(_aggregate, dataarray,
+                                input_core_dims=[[lat, lon]],
+                                output_core_dims=[['county']],
+                                dask='parallelized',
+                                output_dtypes=[np.result_type(dataarray.dtype, np.float64)],
+                                dask_gufunc_kwargs={'output_sizes': {'county': weights.names.size}},
+                                keep_attrs=True)
+    aggregated = aggregated.assign_coords(county=weights.names)
+    return aggregated
+
+
+
+def county_sums(dataarray, weights, lat='lat', lon='lon'):
+    """
+    Keeps the area weighted sums and weight totals for each county instead of the mean, so that 
+    coarser levels (regions, state) can be built from them with rollup
+
+    Inputs:
+        dataarray - (DataArray) Data with lat and lon dimensions (plus any others, e.g. time, model, ens_mem)
+        weights - (CountyWeights) Weights built for the same grid with county_weights
+        lat - (str) Name of the latitude dimension
+        lon - (str) Name of the longitude dimension
+    Output:
+        sums - (Dataset) "weighted_sum", "weight_total" and their ratio "weight_vals", with a county dimension
+
+    """
+    if (dataarray.sizes[lat], dataarray.sizes[lon]) != weights.shape:
+        raise ValueError("Grid of the dataset does not match the grid of the weights")
     
-    # List of years
-    time_str = [str(i) for i in dataset_io['time'].values]
-    print(time_str) 
+    if dataarray.chunks is not None:
+        dataarray = dataarray.chunk({lat: -1, lon: -1})
     
-    shapes = []
-    # Add all bands (here, years)
-    for band in range(1,len(time_str)+1):
-        shapes.append(rasterio.features.shapes(rasterio.band(dataset_tif, band)))
+    def _sums(values):
+        return weighted_sums(values.reshape(values.shape[:-2] + (-1,)), weights.matrix)
     
-    gf_tot = {}
-    shp_tot = {}
-    # Iterate over every timestep
-    for band in range(0, len(time_str)):
-        gf, shp = weighted_aggregation(shapes, band, shapefile, crs)
-        shp = shp.rename({'weight_vals':time_str[band]}, axis='columns')
-        gf_tot[time_str[band]] = gf
-        shp_tot[time_str[band]] = shp
-        print(time_str[band])
+    sum_da, total_da = xr.apply_ufunc(_sums, dataarray,
+                                      input_core_dims=[[lat, lon]],
+                                      output_core_dims=[['county'], ['county']],
+                                      dask='parallelized',
+                                      output_dtypes=[np.float64, np.float64],
+                                      dask_gufunc_kwargs={'output_sizes': {'county': weights.names.size}})
     
-    # https://www.statology.org/pandas-merge-multiple-dataframes/
-    # Merging the geodataframes together so they all have the same geometry
-    shp_fuse = functools.reduce(lambda left,right: pd.merge(left,right,on=['COUNTY_NAM', 'CO_FIPS', 'geometry'], how='left'), shp_tot.values())
-    shp_fuse
+    sums = xr.Dataset({'weighted_sum': sum_da, 'weight_total': total_da})
+    sums = sums.assign_coords(county=weights.names)
+    sums['weight_vals'] = sums['weighted_sum'] / sums['weight_total']
+    return sums
 
-def weighted_aggregation(path_tif, band, shapefile, crs, time_str):
+
+
+def rollup(sums, mapping, dim='region', county='county'):
     """
-    Function to do weighted aggregation over counties
+    Rolls county sums up to a coarser level (e.g. IDPH regions, or the whole state) with a sparse
+    sum, without going back to the grid. The result can be rolled up again.
 
     Inputs:
-        shapes - (list) Polygons
-        band - (int) Band you want (usually time step)
-        shapefile - (Geodataframe) Shapefile to fit dataset to 
-    Outputs:
-        geoframe - (GeoDataFrame) gdf of the original data and geometries
-        shapefile - (GeoDataFrame) Data aggregated to shapefile
+        sums - (Dataset) Output of county_sums (or of a previous rollup)
+        mapping - (dict, Series, DataFrame or str) County name to region name. A DataFrame (or the path to
+                    a CSV of one) uses its first column for counties and its second for regions.
+                    Counties missing from the mapping are left out.
+        dim - (str) Name of the new dimension
+        county - (str) Name of the dimension being rolled up
+    Output:
+        rolled - (Dataset) "weighted_sum", "weight_total" and "weight_vals" along dim
+
+    Ex: state = rollup(sums, {name: 'Illinois' for name in sums.county.values}, dim='state')
 
     """
-    dataset_tif = rasterio.open(path_tif)
-    shapes = rasterio.features.shapes(rasterio.band(dataset_tif, (band+1)))
-            
-    pol = list(shapes)
-    geom = [shapely.geometry.shape(i[0]) for i in pol]
-    # Convert to a GeoSeries
-    geom = gpd.GeoSeries(geom, crs=crs)
+    if isinstance(mapping, (str, os.PathLike)):
+        mapping = pd.read_csv(mapping)
+    if isinstance(mapping, pd.DataFrame):
+        mapping = pd.Series(mapping.iloc[:, 1].values, index=mapping.iloc[:, 0].values)
+    mapping = pd.Series(mapping)
+    
+    names = pd.Index(sums[county].values)
+    regions = pd.unique(mapping.values)
+    region_index = pd.Index(regions)
+    
+    # Sparse (region x county) table of ones
+    rows = region_index.get_indexer(mapping.reindex(names).values)
+    columns = np.arange(names.size)
+    keep = rows >= 0
+    matrix = scipy.sparse.csr_matrix((np.ones(keep.sum()), (rows[keep], columns[keep])),
+                                     shape=(regions.size, names.size))
+    
+    def _rollup(values):
+        flat = values.reshape(-1, values.shape[-1])
+        return (matrix @ flat.T).T.reshape(values.shape[:-1] + (regions.size,))
+    
+    rolled = xr.apply_ufunc(_rollup, sums[['weighted_sum', 'weight_total']],
+                            input_core_dims=[[county]],
+                            output_core_dims=[[dim]],
+                            dask='parallelized',
+                            output_dtypes=[np.float64],
+                            dask_gufunc_kwargs={'output_sizes': {dim: regions.size}})
+    rolled = rolled.assign_coords({dim: regions})
+    rolled['weight_vals'] = rolled['weighted_sum'] / rolled['weight_total']
+    return rolled
 
-    if crs != 'NAD83':
-        # Convert coordinate reference system
-        geom = geom.to_crs('NAD83')
+
+def aggregate_dataset(dataset, weights, lat='lat', lon='lon'):
+    """
+    Aggregates every variable of a Dataset over counties in as few contractions as possible. Variables 
+    with the same dimensions are stacked along a "variable" dimension first, so variables, models,
+    members, schemes and timesteps all go through the same sparse matrix multiplication. Variables with
+    different dimensions (e.g. a lat/lon mask next to model/time fields) are contracted separately, so 
+    none of them get broadcast to the others' dimensions.
+
+    Inputs:
+        dataset - (Dataset) Data with lat and lon dimensions, e.g. from complete_loca2 or OpenLocaCat.load
+        weights - (CountyWeights) Weights built for the same grid with county_weights
+        lat - (str) Name of the latitude dimension
+        lon - (str) Name of the longitude dimension
+    Output:
+        dataset_county - (Dataset) Area weighted means with lat and lon replaced by a county dimension.
+                         Every other dimension of each variable is kept, variables without lat and lon 
+                         are left as is.
+
+    """
+    spatial = [var for var in dataset.data_vars 
+               if lat in dataset[var].dims and lon in dataset[var].dims]
+    if len(spatial) == 0:
+        raise ValueError("No variables with " + lat + " and " + lon + " dimensions")
+    other = [var for var in dataset.data_vars if var not in spatial]
     
-    # Extract values as well
-    values = [i[1] for i in pol]
-    values = pd.Series(values)
+    # One array per set of dimensions
+    groups = {}
+    for var in spatial:
+        groups.setdefault(dataset[var].dims, []).append(var)
 
-    # Create geodataframe
-    geoframe = gpd.GeoDataFrame({'value': values, 'geometry': geom})
+    aggregated = []
+    for group in groups.values():
+        stacked = dataset[group].to_dataarray('variable')
+        aggregated.append(aggregate_counties(stacked, weights, lat, lon).to_dataset('variable'))
     
-    geoframe['area'] = geoframe.area # Area of each square
-    shape_grid = geoframe.overlay(shapefile) # Overlaying the shapefile and the data
+    dataset_county = xr.merge(aggregated, compat='override', join='outer', combine_attrs='drop')
+    for var in spatial:
+        dataset_county[var].attrs = dataset[var].attrs
+    dataset_county = dataset_county.merge(dataset[other].drop_dims([lat, lon], errors='ignore'))
+    dataset_county.attrs = dataset.attrs
+    return dataset_county
 
-    # Creating weighted averages
-    shape_grid['area_sub'] = shape_grid.area # Getting area of each square in each shape
-    shape_grid['area_prop'] = shape_grid['area_sub'] / shape_grid['area'] # Getting proportional area of each square in each shape
-    shape_grid['value_weight'] = shape_grid['value'] * shape_grid['area_prop'] # Getting proportional value based on area
 
-    var_sum_county = shape_grid.groupby('NAME')['value_weight'].sum().reset_index() # Summing data over counties
-    area_prop_county = shape_grid.groupby('NAME')['area_prop'].sum().reset_index() # Summing area proportions over counties
-    area_prop_county['weight_vals'] = var_sum_county['value_weight'] / area_prop_county['area_prop'] # Dividing total weighted data over weights
+
+def county_cube(dataset, shapefile_path, crs, name_col='NAME', cache_dir=weight_cache.CACHE_DIR,
+                lat='lat', lon='lon'):
+    """
+    Loads (or computes) the weights for the grid of a Dataset and aggregates the whole Dataset over counties
+
+    Inputs:
+        dataset - (Dataset or DataArray) Data with lat and lon dimensions
+        shapefile_path - (str) Path to the shapefile or GeoJSON with the counties
+        crs - (str) Coordinate reference system of the data
+        name_col - (str) Column of the shapefile with the county names
+        cache_dir - (str) Directory of the weight cache (None to skip the cache)
+        lat - (str) Name of the latitude dimension
+        lon - (str) Name of the longitude dimension
+    Output:
+        cube - (Dataset or DataArray) Area weighted means with a county dimension instead of lat and lon
+
+    """
+    weights = load_county_weights(dataset[lat].values, dataset[lon].values, shapefile_path, crs,
+                                  name_col=name_col, cache_dir=cache_dir)
+    if isinstance(dataset, xr.DataArray):
+        return aggregate_counties(dataset, weights, lat, lon)
+    return aggregate_dataset(dataset, weights, lat, lon)
+
+
+# Shared inputs of the aggregation workers, set once per worker by _init_worker
+_worker = {}
+
+def _init_worker(shm_name, shape, dtype, matrix):
+    """
+    Pool initializer: attaches each worker to the shared data cube and keeps the weights
+
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    _worker['shm'] = shm
+    _worker['values'] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    _worker['matrix'] = matrix
+
+
+
+def _aggregate_block(bounds):
+    """
+    Aggregates rows start:stop of the shared data cube
+
+    """
+    start, stop = bounds
+    return start, weighted_mean(_worker['values'][start:stop], _worker['matrix'])
+
+
+
+def parallel_aggregate_counties(dataarray, weights, processes=None, block_size=None, lat='lat', lon='lon'):
+    """
+    Aggregates a DataArray over counties with a pool of worker processes. The data cube is put in
+    shared memory and the weights are sent to each worker once, so tasks only carry row ranges.
+
+    Inputs:
+        dataarray - (DataArray) Data with lat and lon dimensions (plus any others, e.g. time, model, ens_mem)
+        weights - (CountyWeights) Weights built for the same grid with county_weights
+        processes - (int) Number of worker processes (default: number of cores)
+        block_size - (int) Number of timesteps (rows of the flattened cube) per task
+        lat - (str) Name of the latitude dimension
+        lon - (str) Name of the longitude dimension
+    Output:
+        aggregated - (DataArray) Area weighted means with lat and lon replaced by a county dimension
+
+    """
+    if (dataarray.sizes[lat], dataarray.sizes[lon]) != weights.shape:
+        raise ValueError("Grid of the dataset does not match the grid of the weights")
+    if processes is None:
+        processes = os.cpu_count()
     
-    shapefile = pd.merge(shapefile, area_prop_county[['NAME', 'weight_vals']], on='NAME', how='left') # Putting the GDF back together
-    shapefile = shapefile[['NAME', 'weight_vals', 'geometry']]
-    shapefile = shapefile.assign(time=str(time_str[band]))
+    dataarray = dataarray.transpose(..., lat, lon)
+    lead = dataarray.shape[:-2]
+    n_rows = int(np.prod(lead))
+    if block_size is None:
+        block_size = max(1, -(-n_rows // (processes * 4))) # A few tasks per worker to balance the load
+    blocks = [(start, min(start + block_size, n_rows)) for start in range(0, n_rows, block_size)]
     
-    if band%10 == 0:
-        print(band)
+    mean = np.empty((n_rows, weights.names.size))
+    shm = shared_memory.SharedMemory(create=True, size=max(dataarray.nbytes, 1))
+    try:
+        # The cube is written straight into shared memory, so there is only ever one copy of it
+        cube = np.ndarray(dataarray.shape, dtype=dataarray.dtype, buffer=shm.buf)
+        if dataarray.chunks is not None:
+            import dask.array
+            dask.array.store(dataarray.data, cube, lock=False) # Chunk by chunk, never computed in full
+        else:
+            cube[...] = dataarray.values
+        shared = cube.reshape(n_rows, -1)
+        del cube
+        
+        with multiprocessing.Pool(processes, initializer=_init_worker, 
+                                  initargs=(shm.name, shared.shape, shared.dtype, weights.matrix)) as pool:
+            # Results come back in order as soon as each block is done
+            for start, block in pool.imap(_aggregate_block, blocks):
+                mean[start:start + block.shape[0]] = block
+        del shared
+    finally:
+        shm.close()
+        shm.unlink()
     
-    return shapefile
+    coords = {name: coord for name, coord in dataarray.coords.items() 
+              if lat not in coord.dims and lon not in coord.dims}
+    coords['county'] = weights.names
+    aggregated = xr.DataArray(mean.reshape(lead + (weights.names.size,)), 
+                              dims=dataarray.dims[:-2] + ('county',), coords=coords,
+                              name=dataarray.name, attrs=dataarray.attrs)
+    return aggregated
 
-#def polygons(path_tif, band, crs):
 
-#    return geom
 
-def agg_call(dataset_io, path_tif, shapefile_path, crs):
+def stream_counties_parquet(dataarray, weights, out_path, time_block=365, name_col='NAME', 
+                            overwrite=False, lat='lat', lon='lon'):
+    """
+    Aggregates a (dask backed) DataArray over counties one block of time at a time, appending
+    each block to a Parquet dataset partitioned by year. Only one block is ever held in memory,
+    and no geometries are written (join them back from the shapefile with name_col).
 
-    dataset_io = dataset_io.rename({'lon':'x', 'lat':'y'})
-    # Open as raster
-    dataset_io = dataset_io.rio.write_crs(crs, inplace=True)
-    # Save as raster (tiff)
-    print(dataset_io.shape)
-    if not os.path.exists(path_tif):
-        dataset_io.rio.to_raster(path_tif)
-    # Opening shapefile
-    shapefile = gpd.read_file(shapefile_path)
+    Inputs:
+        dataarray - (DataArray) Data with time, lat and lon dimensions (plus any others, e.g. model, ens_mem)
+        weights - (CountyWeights) Weights built for the same grid with county_weights
+        out_path - (str) Directory of the Parquet dataset
+        time_block - (int) Number of timesteps computed at once
+        name_col - (str) Name of the county column in the output
+        overwrite - (bool) Replace an existing dataset at out_path
+        lat - (str) Name of the latitude dimension
+        lon - (str) Name of the longitude dimension
+    Output:
+        out_path - (Path) Directory of the Parquet dataset
+
+    """
+    out_path = Path(out_path)
+    if out_path.exists() and any(out_path.iterdir()):
+        if not overwrite:
+            raise FileExistsError(str(out_path) + " already exists. Use overwrite=True to replace it")
+        shutil.rmtree(out_path)
+    
+    name = dataarray.name if dataarray.name is not None else 'weight_vals'
+    n_time = dataarray.sizes['time']
+    for start in range(0, n_time, time_block):
+        block = dataarray.isel(time=slice(start, start + time_block))
+        aggregated = aggregate_counties(block, weights, lat, lon).compute()
+        aggregated = aggregated.assign_coords(year=aggregated['time'].dt.year)
+        
+        # Long format table, one row per county per timestep
+        frame = aggregated.to_dataframe(name=str(name)).reset_index()
+        frame = frame.rename(columns={'county': name_col})
+        frame.to_parquet(out_path, partition_cols=['year'], index=False)
+        print(str(min(start + time_block, n_time)) + '/' + str(n_time))
     
-    # List of years
-    time_str = [str(i) for i in dataset_io['time'].values]
+    return out_path
+
+
+
+def save_county_store(aggregated, shapefile_path, path, name_col='NAME'):
+    """
+    Saves county results with each geometry stored once: a GeoParquet table of the county polygons 
+    and a Zarr store with the values as a dense (county x time x ...) array
+
+    Inputs:
+        aggregated - (DataArray or Dataset) Results with a county dimension, e.g. from aggregate_counties
+        shapefile_path - (str) Path to the shapefile or GeoJSON with the counties
+        path - (str) Directory to save to (holds geometry.parquet and values.zarr)
+        name_col - (str) Column of the shapefile with the county names
+    Output:
+        path - (Path) Directory the results were saved to
+
+    """
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    
+    shapefile = gpd.read_file(shapefile_path)[[name_col, 'geometry']]
+    shapefile = shapefile[shapefile[name_col].isin(aggregated['county'].values)]
+    shapefile.to_parquet(path / 'geometry.parquet', index=False)
     
-    #pool = multiprocessing.Pool(8)
-   # geom_gs = pool.starmap(polygons, zip(, list(range(0,len(time_str))), repeat(crs)))
+    if isinstance(aggregated, xr.DataArray):
+        aggregated = aggregated.to_dataset(name=aggregated.name if aggregated.name is not None else 'weight_vals')
+    aggregated = aggregated.copy() # Leaves the caller's attributes alone
+    aggregated.attrs['name_col'] = name_col
+    aggregated.to_zarr(path / 'values.zarr', mode='w', consolidated=True)
     
-    re = list(zip(repeat(path_tif), list(range(0,len(time_str))), repeat(shapefile), repeat(crs), repeat(time_str)))
-    # Iterate over every timestep
-    pool = multiprocessing.Pool(8)
-    shp_tot = pool.starmap(weighted_aggregation, re)
-    #for band in range(0, len(time_str)):
-    #    gf, shp = weighted_aggregation(shapes, band, shapefile, crs)
-    #    shp = shp.rename({'weight_vals':time_str[band]}, axis='columns')
-    #    gf_tot[time_str[band]] = gf
-    #    shp_tot[time_str[band]] = shp
+    return path
+
+
+
+def open_county_store(path):
+    """
+    Opens county results saved with save_county_store. Values are opened lazily, nothing is 
+    read until it is selected.
+
+    Input:
+        path - (str) Directory the results were saved to
+    Outputs:
+        values - (Dataset) Lazily loaded values with a county dimension
+        geometry - (GeoDataFrame) One polygon per county
+
+    """
+    path = Path(path)
+    values = xr.open_zarr(path / 'values.zarr', consolidated=True)
+    geometry = gpd.read_parquet(path / 'geometry.parquet')
+    return values, geometry
+
+
+
+def county_frame(values, geometry, name_col=None):
+    """
+    Joins (a selection of) county values to their geometries, only loading the values selected
+
+    Inputs:
+        values - (Dataset or DataArray) Values with a county dimension, e.g. values.sel(time='2050')
+        geometry - (GeoDataFrame) One polygon per county, from open_county_store
+        name_col - (str) Column of geometry with the county names (default: the one used to save)
+    Output:
+        frame - (GeoDataFrame) One row per county and per element of the other dimensions
 
+    """
+    if name_col is None:
+        name_col = values.attrs.get('name_col', 'NAME')
+    if isinstance(values, xr.DataArray):
+        values = values.to_dataset(name=values.name if values.name is not None else 'weight_vals')
+    
+    frame = values.to_dataframe().reset_index().rename(columns={'county': name_col})
+    frame = pd.merge(geometry, frame, on=name_col, how='inner')
+    return gpd.GeoDataFrame(frame, geometry='geometry', crs=geometry.crs)
+
+
+
+def raster_to_cells(raster, lat, lon, method='sum'):
+    """
+    Puts a secondary raster (e.g. gridded population or SVI) on the climate grid
+
+    Inputs:
+        raster - (DataArray or str) 2-D raster with x/y or lon/lat coordinates in degrees, or the path 
+                    to a local GeoTIFF or netCDF of one
+        lat - (array) Latitudes of the climate grid cell centers
+        lon - (array) Longitudes of the climate grid cell centers
+        method - (str) "sum" adds up every raster pixel falling in a cell (for counts such as population, 
+                    raster should be finer than the grid), "nearest" takes the pixel at each cell center 
+                    (for rates and indices such as SVI)
+    Output:
+        cells - (array) Raster values for every grid cell, flattened in lat-major order
+
+    """
+    if isinstance(raster, (str, os.PathLike)):
+        if str(raster).endswith('.nc'):
+            raster = xr.open_dataarray(raster)
+        else:
+            raster = rioxarray.open_rasterio(raster, masked=True)
+    raster = raster.squeeze(drop=True)
+    raster = raster.rename({dim: new for dim, new in (('x', 'lon'), ('y', 'lat')) if dim in raster.dims})
+    raster = raster.transpose('lat', 'lon')
+    
+    lat = np.asarray(lat, dtype=float)
+    lon = np.asarray(lon, dtype=float) % 360 # Both on the 0-360 longitude scale
+    r_lat = raster['lat'].values.astype(float)
+    r_lon = raster['lon'].values.astype(float) % 360
+    values = np.asarray(raster.values, dtype=float)
     
-    # https://www.statology.org/pandas-merge-multiple-dataframes/
-    # Merging the geodataframes together so they all have the same geometry
-    shp_fuse = pd.concat(shp_tot,ignore_index=True)
-    return shp_fuse
\ No newline at end of file
+    if method == 'nearest':
+        sample = raster.assign_coords(lon=r_lon).sortby(['lat', 'lon'])
+        cells = sample.sel(lat=xr.DataArray(np.repeat(lat, lon.size)), 
+                           lon=xr.DataArray(np.tile(lon, lat.size)), method='nearest')
+        return np.nan_to_num(cells.values.astype(float))
+    elif method != 'sum':
+        raise ValueError("method must be 'sum' or 'nearest'")
+    
+    def _cell_index(centers, points):
+        # Cell each point falls in, -1 if outside the grid
+        edges = cell_edges(centers)
+        flip = edges[0] > edges[-1]
+        if flip:
+            edges = edges[::-1]
+        index = np.searchsorted(edges, points, side='right') - 1
+        outside = (index < 0) | (index >= centers.size)
+        if flip:
+            index = centers.size - 1 - index
+        return np.where(outside, -1, index)
+    
+    lat_index = _cell_index(lat, r_lat)
+    lon_index = _cell_index(lon, r_lon)
+    lat_i, lon_i = np.meshgrid(lat_index, lon_index, indexing='ij')
+    inside = (lat_i >= 0) & (lon_i >= 0) & ~np.isnan(values)
+    
+    cells = np.bincount((lat_i * lon.size + lon_i)[inside], weights=values[inside], 
+                        minlength=lat.size * lon.size)
+    return cells
+
+
+
+def secondary_weights(weights, raster, method='sum'):
+    """
+    Combines county area weights with a secondary weight raster (e.g. population) into one 
+    precomputed matrix. Aggregating with the result (aggregate_counties, county_sums, zonal_statistics) 
+    gives e.g. population weighted exposure at the same cost as the plain area mean.
+
+    Inputs:
+        weights - (CountyWeights) Area weights from county_weights or load_county_weights
+        raster - (DataArray or str) Secondary weights, or the path to a local GeoTIFF or netCDF (see raster_to_cells)
+        method - (str) "sum" for counts (population), "nearest" for rates and indices (SVI)
+    Output:
+        combined - (CountyWeights) Weights of area x secondary weight
+
+    """
+    cells = raster_to_cells(raster, weights.lat, weights.lon, method)
+    matrix = weights.matrix.multiply(cells[np.newaxis, :]).tocsr()
+    matrix.eliminate_zeros()
+    return CountyWeights(matrix, weights.names, weights.lat, weights.lon)
@@ -1,9 +1,11 @@
 from LOCA2.LOCA2_processor import loca2_processing
+from ERA5.era5il_models import IL_boundaries
+from calculations.ensemble import reduce_runs
 import xarray as xr
 import numpy as np
 
 
-def complete_loca2(scenario, year_start, year_end):
+def complete_loca2(scenario, year_start, year_end, boundaries=IL_boundaries):
     """
     Code to create a LOCA2 dataset that contains all three variables (tasmax [maximum daily temperature],
         tasmin [minimum daily temperature], and pr [precipitation]) within the desired time range and in
@@ -13,14 +15,15 @@ def complete_loca2(scenario, year_start, year_end):
         - scenario (str) - historical, ssp245, ssp370, ssp585
         - year_start (int) - First year you'd like to request
         - year_end (int) - Last year you'd like to request (inclusive)
+        - boundaries (GeographicBoundaries) - Bounding box to pull (default: Illinois)
     Output:
         - data_full (Dataset) - Contains tasmax, tasmin, precip from year_start to year_end in scenario
         
     """
     
-    data_tasmax = loca2_processing(scenario, 'tasmax', year_start, year_end)
-    data_tasmin = loca2_processing(scenario, 'tasmin', year_start, year_end)
-    data_precip = loca2_processing(scenario, 'pr', year_start, year_end)
+    data_tasmax = loca2_processing(scenario, 'tasmax', year_start, year_end, boundaries)
+    data_tasmin = loca2_processing(scenario, 'tasmin', year_start, year_end, boundaries)
+    data_precip = loca2_processing(scenario, 'pr', year_start, year_end, boundaries)
     
     data_full = xr.merge([data_tasmax, data_tasmin, data_precip], fill_value=np.nan)
     return data_full
@@ -32,20 +35,27 @@ def stats(dataset):
     Calculates statistics across the models for all variables
     
     Input:
-        - dataset (Dataset or Dataarray) - Needs a dimension called "model"
+        - dataset (Dataset or Dataarray) - Needs a dimension called "model", or a "run" dimension
+            with a "model" level (see calculations.ensemble.stack_runs)
     Output:
         - data_stats (Dataset) - Contains calculations of the mean, standard deviation, and variance
             of the dataset. All statistics stored in a coordinate called "stats"
             
     """
     
-    mean = dataset.mean('model')
+    def across_models(how):
+        if 'run' in dataset.dims:
+            # Ragged ensemble, same as reducing over "model" of the padded cube
+            return reduce_runs(dataset, how, 'model')
+        return getattr(dataset, how)('model')
+
+    mean = across_models('mean')
     mean['stats'] = 'mean'
     
-    stdev = dataset.std('model')
+    stdev = across_models('std')
     stdev['stats'] = 'stdev'
     
-    variance = dataset.var('model')
+    variance = across_models('var')
     variance['stats'] = 'variance'
     
     data_stats = xr.concat([mean, stdev, variance], 'stats')
@@ -0,0 +1,241 @@
+import re
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+
+# Length of each unit of "<units> since <date>" in days
+UNIT_DAYS = {'days': 1, 'day': 1, 'd': 1, 'hours': 1 / 24, 'hour': 1 / 24, 'h': 1 / 24,
+             'minutes': 1 / 1440, 'minute': 1 / 1440, 'seconds': 1 / 86400, 'second': 1 / 86400, 's': 1 / 86400}
+UNITS_PATTERN = re.compile(r'^\s*(\w+)\s+since\s+(-?\d+)-(\d+)-(\d+)(?:[ T](\d+):(\d+)(?::(\d+(?:\.\d*)?))?)?')
+
+# standard/gregorian switch to the Julian calendar before 1582-10-15, which none of the data reaches
+STANDARD = {'standard', 'gregorian', 'proleptic_gregorian'}
+JULIAN = {'julian'}
+NOLEAP = {'noleap', '365_day'}
+ALL_LEAP = {'all_leap', '366_day'}
+DAY_360 = {'360_day'}
+
+# Lookup tables: day of the year (0-based) to month and day of month
+NOLEAP_DAYS = np.array([31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])
+LEAP_DAYS = np.array([31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])
+NOLEAP_MONTH = np.repeat(np.arange(12), NOLEAP_DAYS)
+NOLEAP_DAY = np.concatenate([np.arange(n) for n in NOLEAP_DAYS])
+LEAP_MONTH = np.repeat(np.arange(12), LEAP_DAYS)
+LEAP_DAY = np.concatenate([np.arange(n) for n in LEAP_DAYS])
+# 360-day years spread evenly over real years (day of the 360-day year to day of the real year)
+SPREAD_365 = np.round(np.arange(360) * 365 / 360).astype(int)
+SPREAD_366 = np.round(np.arange(360) * 366 / 360).astype(int)
+
+LEAP_DAY_POLICIES = ('drop', 'fill', 'interpolate')
+# Julian day number of 1970-01-01
+UNIX_JDN = 2440588
+
+
+
+def parse_units(units):
+    """
+    Reads CF time units
+
+    Input:
+        units - (str) e.g. "days since 1950-01-01 00:00:00"
+    Outputs:
+        unit_days - (float) Length of one unit in days
+        origin - (tuple) Year, month, day of the reference date
+        origin_fraction - (float) Time of day of the reference date (in days)
+
+    """
+    match = UNITS_PATTERN.match(units)
+    if match is None or match.group(1).lower() not in UNIT_DAYS:
+        raise ValueError("Unsupported time units: " + str(units))
+
+    unit_days = UNIT_DAYS[match.group(1).lower()]
+    origin = (int(match.group(2)), int(match.group(3)), int(match.group(4)))
+    hour, minute, second = (float(match.group(i)) if match.group(i) else 0 for i in (5, 6, 7))
+    origin_fraction = (hour * 3600 + minute * 60 + second) / 86400
+    return unit_days, origin, origin_fraction
+
+
+
+def _is_leap(years):
+    return (years % 4 == 0) & ((years % 100 != 0) | (years % 400 == 0))
+
+
+
+def _julian_day_number(year, month, day):
+    """
+    Julian day number of a date on the Julian calendar
+
+    """
+    a = (14 - month) // 12
+    y = year + 4800 - a
+    m = month + 12 * a - 3
+    return day + (153 * m + 2) // 5 + 365 * y + y // 4 - 32083
+
+
+
+def _from_parts(years, months, days):
+    """
+    Builds datetime64[D] from arrays of years, 0-based months and 0-based days of the month
+
+    """
+    year_start = (years - 1970).astype('datetime64[Y]')
+    return (year_start.astype('datetime64[M]') + months).astype('datetime64[D]') + days
+
+
+
+def day_numbers(offsets, units):
+    """
+    Turns raw time offsets into whole day counts from the reference date
+
+    Inputs:
+        offsets - (array) Raw (undecoded) time values
+        units - (str) CF time units, e.g. "days since 1950-01-01"
+    Outputs:
+        days - (array) Integer days since the reference date
+        origin - (tuple) Year, month, day of the reference date
+
+    """
+    unit_days, origin, origin_fraction = parse_units(units)
+    days = np.floor(np.asarray(offsets, dtype='float64') * unit_days + origin_fraction + 1e-9)
+    return days.astype('int64'), origin
+
+
+
+def to_datetime64(offsets, units, calendar='standard'):
+    """
+    Maps raw time offsets of any CF calendar to real dates with lookup tables, without making
+    any cftime objects. noleap dates keep their month and day (there is never a Feb 29),
+    all_leap Feb 29ths in non-leap years become NaT and 360_day years are spread evenly over
+    the real year.
+
+    Inputs:
+        offsets - (array) Raw (undecoded) time values
+        units - (str) CF time units, e.g. "days since 1950-01-01"
+        calendar - (str) CF calendar (standard, gregorian, proleptic_gregorian, julian, noleap, 365_day,
+                    all_leap, 366_day, 360_day)
+    Output:
+        dates - (array) datetime64[ns] dates
+
+    """
+    calendar = calendar.lower()
+    days, (year0, month0, day0) = day_numbers(offsets, units)
+
+    if calendar in STANDARD:
+        origin = np.datetime64('{:04d}-{:02d}-{:02d}'.format(year0, month0, day0), 'D')
+        dates = origin + days.astype('timedelta64[D]')
+    elif calendar in JULIAN:
+        # Days are counted the same way, only the reference date needs converting
+        # (Julian dates run 13 days behind Gregorian ones today)
+        number = _julian_day_number(year0, month0, day0) - UNIX_JDN + days
+        dates = np.datetime64('1970-01-01', 'D') + number.astype('timedelta64[D]')
+    elif calendar in NOLEAP:
+        number = year0 * 365 + np.cumsum(np.r_[0, NOLEAP_DAYS])[month0 - 1] + day0 - 1 + days
+        years, doy = np.divmod(number, 365)
+        dates = _from_parts(years, NOLEAP_MONTH[doy], NOLEAP_DAY[doy])
+    elif calendar in ALL_LEAP:
+        number = year0 * 366 + np.cumsum(np.r_[0, LEAP_DAYS])[month0 - 1] + day0 - 1 + days
+        years, doy = np.divmod(number, 366)
+        dates = _from_parts(years, LEAP_MONTH[doy], LEAP_DAY[doy])
+        # Feb 29 of a non-leap year doesn't exist
+        missing = (doy == 59) & ~_is_leap(years)
+        dates = np.where(missing, np.datetime64('NaT'), dates)
+    elif calendar in DAY_360:
+        number = year0 * 360 + (month0 - 1) * 30 + day0 - 1 + days
+        years, doy = np.divmod(number, 360)
+        shift = np.where(_is_leap(years), SPREAD_366[doy], SPREAD_365[doy])
+        dates = (years - 1970).astype('datetime64[Y]').astype('datetime64[D]') + shift
+    else:
+        raise ValueError("Unsupported calendar: " + calendar)
+
+    return np.asarray(dates, dtype='datetime64[ns]')
+
+
+
+def normalize_time(dataset, leap_day='drop', time='time'):
+    """
+    Decodes the time of a dataset opened with decode_times=False into datetime64 on the real
+    calendar. Can be used as the preprocess step of open_mfdataset.
+
+    Inputs:
+        dataset - (Dataset) Dataset opened with decode_times=False
+        leap_day - (str) What to do with days that the model calendar doesn't have (Feb 29 of
+                    noleap models, the days skipped when spreading 360_day years) and that it has
+                    but the real calendar doesn't (Feb 29 of all_leap models in non-leap years):
+                        "drop" - leave missing days out, drop days that don't exist
+                        "fill" - add missing days as NaN, drop days that don't exist
+                        "interpolate" - add missing days, linearly interpolated in time
+        time - (str) Name of the time coordinate
+    Output:
+        dataset - (Dataset) Dataset with datetime64 times (and time bounds, reindexed with time
+                    under "fill" and "interpolate"). The model calendar is kept in the
+                    "source_calendar" attribute of time.
+
+    """
+    if leap_day not in LEAP_DAY_POLICIES:
+        raise ValueError("leap_day must be one of " + ', '.join(LEAP_DAY_POLICIES))
+
+    attrs = dict(dataset[time].attrs)
+    encoding = dict(dataset[time].encoding)
+    units = attrs.pop('units', None) or encoding.get('units')
+    calendar = attrs.pop('calendar', None) or encoding.get('calendar', 'standard')
+    if units is None or np.issubdtype(dataset[time].dtype, np.datetime64):
+        return dataset # Already decoded
+
+    dates = to_datetime64(dataset[time].values, units, calendar)
+    attrs['source_calendar'] = calendar
+    dataset = dataset.assign_coords({time: dates})
+    dataset[time].attrs = attrs
+
+    # Time bounds are in the same units and calendar as time
+    bounds = attrs.get('bounds')
+    if bounds is not None and bounds in dataset.variables:
+        raw = dataset[bounds]
+        decoded = to_datetime64(raw.values.ravel(), units, calendar).reshape(raw.shape)
+        bounds_attrs = {key: value for key, value in raw.attrs.items() if key not in ('units', 'calendar')}
+        dataset[bounds] = xr.Variable(raw.dims, decoded, bounds_attrs)
+    else:
+        bounds = None
+
+    # Days that don't exist on the real calendar
+    if np.isnat(dates).any():
+        dataset = dataset.isel({time: ~np.isnat(dates)})
+
+    if leap_day != 'drop' and calendar.lower() not in STANDARD | JULIAN and dataset.sizes[time] > 1:
+        full = pd.date_range(dataset[time].values[0], dataset[time].values[-1], freq='D')
+        # Bounds are rebuilt separately, interpolating dates makes no sense
+        bounds_var = dataset[bounds].reindex({time: full}) if bounds is not None else None
+        if bounds is not None:
+            dataset = dataset.drop_vars(bounds)
+        dataset = dataset.reindex({time: full})
+        if leap_day == 'interpolate':
+            if any(variable.chunks is not None for variable in dataset.data_vars.values()):
+                # Files chunked along time on disk open with several time chunks, interpolation needs one
+                dataset = dataset.chunk({time: -1})
+            dataset = dataset.interpolate_na(dim=time, method='linear', limit=5)
+        dataset[time].attrs = attrs
+        if bounds is not None:
+            dataset[bounds] = bounds_var
+
+    if bounds is not None:
+        dataset[bounds] = _fill_bounds(dataset[bounds], time)
+
+    return dataset
+
+
+
+def _fill_bounds(bounds, time='time'):
+    """
+    Sets the (start, end) bounds missing after decoding (added days, or ends falling on days the real 
+    calendar doesn't have) to the day itself and the day after
+
+    """
+    values = bounds.values.copy()
+    if values.ndim != 2 or values.shape[-1] != 2 or not np.isnat(values).any():
+        return bounds
+    day = bounds[time].values.astype('datetime64[D]').astype('datetime64[ns]')
+    start, end = np.isnat(values[:, 0]), np.isnat(values[:, 1])
+    values[start, 0] = day[start]
+    values[end, 1] = day[end] + np.timedelta64(1, 'D')
+    return bounds.copy(data=values)
@@ -0,0 +1,159 @@
+import numpy as np
+import xarray as xr
+
+
+# Named output encodings:
+#   none - library defaults (uncompressed, dtype of the data)
+#   float32 - float32 with zlib
+#   zstd - float32 with zstd (needs netCDF4 with the HDF5 zstd filter)
+#   packed - int16 with scale_factor/add_offset for temperature and precipitation, float32 with zlib otherwise
+PROFILES = ('none', 'float32', 'zstd', 'packed')
+# Chunk layouts: 'time' for maps (blocks of time over the whole grid), 'space' for time series
+# (whole time series over small tiles)
+LAYOUTS = ('time', 'space')
+TARGET_CHUNK_BYTES = 4 * 1024**2
+
+SPATIAL_DIMS = ('lat', 'lon', 'latitude', 'longitude', 'y', 'x')
+
+TEMPERATURE = {'tas', 'tasmax', 'tasmin', 't2m', 'd2m', 'skt', 'sst', '2m_temperature',
+               '2m_dewpoint_temperature', 'heat_index'}
+PRECIPITATION = {'pr', 'tp', 'precipitation', 'total_precipitation'}
+# Range of values kept by packing, by units
+TEMPERATURE_RANGE = {'K': (150.0, 350.0)}
+PRECIPITATION_RANGE = {'kg m-2 s-1': (0.0, 0.015), 'kg/m2/s': (0.0, 0.015), 'kg m**-2 s**-1': (0.0, 0.015),
+                       'mm/day': (0.0, 1500.0), 'mm d-1': (0.0, 1500.0), 'mm': (0.0, 1500.0), 'm': (0.0, 1.5)}
+PACKED_FILL = -32768
+
+
+
+def pack_range(name, units):
+    """
+    Range to pack a variable into, if it is a temperature or precipitation in known units
+
+    Inputs:
+        name - (str) Variable name
+        units - (str or None) Units attribute of the variable
+    Output:
+        valid_range - (tuple or None) Lowest and highest value kept, None if the variable isn't packed
+
+    """
+    if name in TEMPERATURE:
+        return TEMPERATURE_RANGE.get(units)
+    if name in PRECIPITATION:
+        return PRECIPITATION_RANGE.get(units)
+    return None
+
+
+
+def chunk_shape(variable, itemsize, layout='time', time_dim='time', target_bytes=TARGET_CHUNK_BYTES):
+    """
+    Chunk shape of a variable for an access pattern, about target_bytes per chunk
+
+    Inputs:
+        variable - (DataArray) Variable to be written
+        itemsize - (int) Bytes per value once encoded
+        layout - (str) 'time' or 'space' (see LAYOUTS)
+        time_dim - (str) Name of the time dimension
+        target_bytes - (int) Size of a chunk
+    Output:
+        chunks - (tuple or None) Chunk size along each dimension, None to leave it to the library
+
+    """
+    sizes = dict(variable.sizes)
+    if time_dim not in sizes or 0 in sizes.values():
+        return None
+    spatial = [dim for dim in variable.dims if dim in SPATIAL_DIMS]
+    chunks = {dim: 1 for dim in variable.dims}
+
+    if layout == 'time':
+        grid_bytes = int(np.prod([sizes[dim] for dim in spatial])) * itemsize
+        for dim in spatial:
+            chunks[dim] = sizes[dim]
+        chunks[time_dim] = int(np.clip(target_bytes // grid_bytes, 1, sizes[time_dim]))
+    elif layout == 'space':
+        chunks[time_dim] = sizes[time_dim]
+        tile = int(np.sqrt(target_bytes / (sizes[time_dim] * itemsize)))
+        for dim in spatial:
+            chunks[dim] = int(np.clip(tile, 1, sizes[dim]))
+    else:
+        raise ValueError("layout must be one of " + ', '.join(LAYOUTS))
+
+    return tuple(chunks[dim] for dim in variable.dims)
+
+
+
+def encoding_for(dataset, profile='float32', layout='time', complevel=4, time_dim='time'):
+    """
+    Builds the to_netcdf encoding of every floating point data variable for a profile
+
+    Inputs:
+        dataset - (Dataset) Dataset to be written
+        profile - (str) One of PROFILES
+        layout - (str) One of LAYOUTS
+        complevel - (int) Compression level
+        time_dim - (str) Name of the time dimension
+    Output:
+        encoding - (dict) Variable name to encoding
+
+    """
+    if profile not in PROFILES:
+        raise ValueError("profile must be one of " + ', '.join(PROFILES))
+    if profile == 'none':
+        return {}
+
+    encoding = {}
+    for name, variable in dataset.data_vars.items():
+        if not np.issubdtype(variable.dtype, np.floating):
+            continue
+
+        valid_range = pack_range(name, variable.attrs.get('units')) if profile == 'packed' else None
+        if valid_range is not None:
+            low, high = valid_range
+            var_encoding = {'dtype': 'int16', 'scale_factor': (high - low) / 65534,
+                            'add_offset': (high + low) / 2, '_FillValue': PACKED_FILL}
+        else:
+            var_encoding = {'dtype': 'float32', '_FillValue': np.float32(np.nan)}
+
+        if profile == 'zstd':
+            var_encoding.update({'compression': 'zstd', 'complevel': complevel, 'shuffle': True})
+        else:
+            var_encoding.update({'zlib': True, 'complevel': complevel, 'shuffle': True})
+
+        chunks = chunk_shape(variable, np.dtype(var_encoding['dtype']).itemsize, layout, time_dim)
+        if chunks is not None:
+            var_encoding['chunksizes'] = chunks
+        encoding[name] = var_encoding
+    return encoding
+
+
+
+def to_netcdf(data, path, profile='float32', layout='time', complevel=4, time_dim='time'):
+    """
+    Writes a Dataset or DataArray to netCDF with an encoding profile
+
+    Inputs:
+        data - (Dataset or DataArray) Data to be written
+        path - (str) Output file
+        profile - (str) One of PROFILES
+        layout - (str) One of LAYOUTS
+        complevel - (int) Compression level
+        time_dim - (str) Name of the time dimension
+    Output:
+        path - (str) Output file
+
+    """
+    if isinstance(data, xr.DataArray):
+        name = data.name if data.name is not None else '__xarray_dataarray_variable__'
+        dataset = data.to_dataset(name=name)
+    else:
+        dataset = data
+
+    if profile != 'none':
+        # Encoding carried over from the source files would clash with the profile
+        dataset = dataset.copy()
+        for var in dataset.data_vars:
+            dataset[var].encoding = {}
+    encoding = encoding_for(dataset, profile, layout, complevel, time_dim)
+
+    dataset.to_netcdf(path, encoding=encoding)
+    return path
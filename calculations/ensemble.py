@@ -0,0 +1,73 @@
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+
+def stack_runs(runs, levels=('model', 'ens_mem'), run='run'):
+    """
+    Puts ensemble members together along a single "run" dimension holding only the members
+    that exist, instead of a model x member cube padded with NaN for models with fewer members
+
+    Inputs:
+        runs - (list) (labels, Dataset) of every member, with labels a tuple matching levels,
+                ex: [(('ACCESS-CM2', 0), dataset), (('ACCESS-CM2', 1), dataset), (('CESM2-LENS', 0), dataset), ...]
+        levels - (tuple) Names of the levels of the run MultiIndex
+        run - (str) Name of the stacked dimension
+    Output:
+        dataset - (Dataset) Members along run, indexed by a MultiIndex of levels
+
+    """
+    if len(runs) == 0:
+        raise ValueError("No ensemble members to stack")
+
+    datasets = []
+    for labels, dataset in runs:
+        # Scalar labels left on the members would clash with the MultiIndex
+        dataset = dataset.drop_vars([level for level in levels if level in dataset.variables])
+        datasets.append(dataset.expand_dims(run))
+    dataset = xr.concat(datasets, dim=run, coords='minimal', compat='override')
+
+    index = pd.MultiIndex.from_tuples([labels for labels, _ in runs], names=list(levels))
+    dataset = dataset.assign_coords(xr.Coordinates.from_pandas_multiindex(index, run))
+    return dataset
+
+
+
+def reduce_runs(dataset, how, dim='model', run='run'):
+    """
+    Reduces over one level of the run MultiIndex, which is the same as reducing over that
+    dimension of the padded cube, ex: reduce_runs(dataset, 'mean', 'model') for dataset.mean('model')
+
+    Inputs:
+        dataset - (Dataset or DataArray) Data with a run dimension (see stack_runs)
+        how - (str) Reduction, ex: 'mean', 'std', 'var', 'min', 'max', 'median'
+        dim - (str) Level to reduce over
+        run - (str) Name of the stacked dimension
+    Output:
+        reduced - (Dataset or DataArray) With run indexed by the remaining levels (or a plain dimension
+                    named after the remaining level if only one is left)
+
+    """
+    index = dataset.indexes[run]
+    if dim not in index.names:
+        raise ValueError(dim + " is not a level of " + run + ": " + str(list(index.names)))
+
+    keep = [level for level in index.names if level != dim]
+    if len(keep) == 0:
+        return getattr(dataset, how)(run)
+
+    # Every combination of the remaining levels is a group
+    kept = index.droplevel(dim)
+    codes, groups = pd.factorize(kept)
+
+    along_run = [name for name, coord in dataset.coords.items() if run in coord.dims]
+    grouped = dataset.drop_vars(along_run).assign_coords(group_=(run, codes))
+    reduced = getattr(grouped.groupby('group_'), how)(run)
+    reduced = reduced.drop_vars('group_').rename({'group_': run})
+
+    if len(keep) == 1:
+        reduced = reduced.assign_coords({keep[0]: (run, np.asarray(groups))}).swap_dims({run: keep[0]})
+    else:
+        reduced = reduced.assign_coords(xr.Coordinates.from_pandas_multiindex(pd.MultiIndex.from_tuples(
+                                                                groups, names=keep), run))
+    return reduced
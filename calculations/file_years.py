@@ -0,0 +1,55 @@
+import os
+import re
+
+
+# Year spans such as 2015-2044 (LOCA2) or 20150101-20441231
+SPAN_PATTERN = re.compile(r'(?<![\dv])(\d{4})\d{0,4}-(\d{4})\d{0,4}(?!\d)')
+# Single years such as _2015_ or _2015.nc (NEX-GDDP-CMIP6, one file per year)
+YEAR_PATTERN = re.compile(r'(?<=[._])(\d{4})(?=[._])')
+
+
+
+def file_years(path):
+    """
+    Finds the years covered by a file from its name
+
+    Input:
+        path - (str) File path, e.g. tasmax.ACCESS-CM2.ssp245.r1i1p1f1.2015-2044.LOCA_16thdeg_v20220413.cent.nc
+                or huss_day_ACCESS-CM2_ssp370_r1i1p1f1_gn_2015_v1.1_illinois.nc
+    Output:
+        years - (tuple or None) First and last year (inclusive), None if the name has no years
+
+    """
+    name = os.path.basename(path)
+
+    span = SPAN_PATTERN.search(name)
+    if span:
+        return int(span.group(1)), int(span.group(2))
+
+    year = YEAR_PATTERN.findall(name)
+    if len(year) == 1:
+        return int(year[0]), int(year[0])
+
+    return None
+
+
+
+def prune_files(paths, year_start, year_end):
+    """
+    Keeps only the files whose years overlap the requested years, so that files outside of them
+    never get opened. Files without years in their names are always kept.
+
+    Inputs:
+        paths - (list) File paths
+        year_start - (int) First year requested
+        year_end - (int) Last year requested (inclusive)
+    Output:
+        pruned - (list) File paths overlapping year_start to year_end, in the original order
+
+    """
+    pruned = []
+    for path in paths:
+        years = file_years(path)
+        if years is None or (years[0] <= year_end and years[1] >= year_start):
+            pruned.append(path)
+    return pruned
@@ -0,0 +1,164 @@
+import argparse
+import shutil
+
+import numpy as np
+import xarray as xr
+
+
+def _open(source):
+    """
+    Opens a store or file lazily, or passes a Dataset through
+
+    """
+    if isinstance(source, (xr.Dataset, xr.DataArray)):
+        return source
+    if str(source).endswith('.nc'):
+        return xr.open_dataset(source, chunks={})
+    return xr.open_zarr(source)
+
+
+
+def space_tile(dataset, max_mem, time_dim='time', lat='lat', lon='lon'):
+    """
+    Largest square lat/lon tile whose full time series fits in a memory budget
+
+    Inputs:
+        dataset - (Dataset) Dataset to be rechunked
+        max_mem - (int) Memory budget for one chunk (bytes)
+        time_dim - (str) Name of the time dimension
+        lat - (str) Name of the latitude dimension
+        lon - (str) Name of the longitude dimension
+    Output:
+        tile - (int) Number of cells along lat and lon in each chunk
+
+    """
+    itemsize = max(dataset[var].dtype.itemsize for var in dataset.data_vars)
+    # Half the budget, the other half is for the pieces being read
+    cells = max_mem / 2 / (dataset.sizes[time_dim] * itemsize)
+    tile = int(np.floor(np.sqrt(cells)))
+    return int(np.clip(tile, 1, max(dataset.sizes[lat], dataset.sizes[lon])))
+
+
+
+def rechunk_space_major(source, target_store, temp_store, max_mem=2 * 1024**3,
+                        time_dim='time', lat='lat', lon='lon'):
+    """
+    Writes a space-major copy of a time-major dataset (whole time series of a small lat/lon tile
+    per chunk), for fast point and county time series. Works in two passes through a temporary
+    store, like rechunker, so no task holds more than about max_mem:
+        1. Each source chunk (a block of time over the whole grid) is split into tiles and written
+        2. Each target chunk is built from the tiles of one lat/lon tile over every block of time
+
+    Inputs:
+        source - (Dataset or str) Time-major Dataset, Zarr store or netCDF (e.g. processed LOCA2,
+                    NEX-GDDP-CMIP6 or ERA5 Illinois data)
+        target_store - (str) Zarr store to write the space-major copy to
+        temp_store - (str) Zarr store for the intermediate copy (removed at the end)
+        max_mem - (int) Memory budget for one chunk (bytes)
+        time_dim - (str) Name of the time dimension
+        lat - (str) Name of the latitude dimension
+        lon - (str) Name of the longitude dimension
+    Output:
+        target_store - (str) Zarr store of the space-major copy
+
+    """
+    dataset = _open(source)
+    if isinstance(dataset, xr.DataArray):
+        dataset = dataset.to_dataset(name=dataset.name if dataset.name is not None else 'data')
+    dataset = dataset.copy() # Shallow, so the caller's encodings survive
+    for var in dataset.variables:
+        # Chunking of the source doesn't apply to the copies
+        dataset[var].encoding = {}
+
+    tile = space_tile(dataset, max_mem, time_dim, lat, lon)
+    other = {dim: 1 for dim in dataset.dims if dim not in (time_dim, lat, lon)}
+
+    # Blocks of time of the source, small enough for the budget
+    if dataset.chunks and dataset.chunks.get(time_dim):
+        time_block = max(dataset.chunks[time_dim])
+    else:
+        time_block = dataset.sizes[time_dim]
+    itemsize = max(dataset[var].dtype.itemsize for var in dataset.data_vars)
+    grid_bytes = dataset.sizes[lat] * dataset.sizes[lon] * itemsize
+    time_block = int(max(1, min(time_block, max_mem // 2 // grid_bytes)))
+
+    # Pass 1: time blocks split into tiles
+    intermediate = dataset.chunk({time_dim: time_block, lat: tile, lon: tile, **other})
+    intermediate.to_zarr(temp_store, mode='w')
+    print('Intermediate copy saved to ' + str(temp_store))
+
+    # Pass 2: every time block of a tile put together
+    target = xr.open_zarr(temp_store).chunk({time_dim: -1, lat: tile, lon: tile, **other})
+    for var in target.variables:
+        target[var].encoding = {}
+    target.attrs['chunking'] = 'space-major'
+    target.to_zarr(target_store, mode='w', consolidated=True)
+    print('Space-major copy saved to ' + str(target_store))
+
+    shutil.rmtree(temp_store, ignore_errors=True)
+    return target_store
+
+
+
+def _chunks_read(dataset, indexers):
+    """
+    Number of chunks read (times chunk volume) to pull a selection out of a lazily opened dataset
+
+    """
+    cost = 1
+    for dim, sizes in dataset.chunksizes.items():
+        bounds = np.cumsum((0,) + tuple(sizes))
+        if dim in indexers:
+            position = xr.DataArray(np.arange(dataset.sizes[dim]), coords={dim: dataset[dim]}, dims=dim)
+            key = indexers[dim]
+            if isinstance(key, slice):
+                position = position.sel({dim: key})
+            else:
+                position = position.sel({dim: key}, method='nearest')
+            position = np.atleast_1d(position.values)
+        else:
+            position = np.arange(dataset.sizes[dim])
+        chunk_ids = np.unique(np.searchsorted(bounds, position, side='right') - 1)
+        cost *= np.sum(np.diff(bounds)[chunk_ids])
+    return cost
+
+
+
+def open_for_query(time_major, space_major, **indexers):
+    """
+    Picks whichever copy (time-major or space-major) reads the least data for a selection,
+    and returns the selection from it, loaded lazily
+
+    Inputs:
+        time_major - (Dataset or str) Time-major Dataset, Zarr store or netCDF
+        space_major - (Dataset or str) Space-major copy from rechunk_space_major
+        indexers - Selection by coordinate values, e.g. lat=40.1, lon=271.8 or time=slice('2050', '2060')
+                    (scalars and lists are matched to the nearest value)
+    Output:
+        selection - (Dataset) Selected data from the cheaper copy
+
+    ex: series = open_for_query('LOCA2_IL.zarr', 'LOCA2_IL_space.zarr', lat=40.1, lon=271.8)
+
+    """
+    candidates = [_open(time_major), _open(space_major)]
+    costs = [_chunks_read(dataset, indexers) for dataset in candidates]
+    dataset = candidates[int(np.argmin(costs))]
+
+    slices = {dim: key for dim, key in indexers.items() if isinstance(key, slice)}
+    points = {dim: key for dim, key in indexers.items() if not isinstance(key, slice)}
+    selection = dataset.sel(slices)
+    if points:
+        selection = selection.sel(points, method='nearest')
+    return selection
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--source", required=True, type=str)
+    parser.add_argument("--target", required=True, type=str)
+    parser.add_argument("--temp", required=True, type=str)
+    parser.add_argument("--max_mem", required=False, type=int, default=2 * 1024**3)
+    args = parser.parse_args()
+
+    rechunk_space_major(args.source, args.target, args.temp, args.max_mem)
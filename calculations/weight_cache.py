@@ -0,0 +1,152 @@
+import hashlib
+import os
+from pathlib import Path
+
+import numpy as np
+import scipy.sparse
+
+
+# Cache location can be moved with the CLIMATE_MAP_CACHE environment variable
+CACHE_DIR = Path(os.environ.get('CLIMATE_MAP_CACHE', Path.home() / '.cache' / 'climate_map')) / 'weights'
+MAX_BYTES = 2 * 1024**3 # 2 GB
+
+
+
+def boundary_files(shapefile_path):
+    """
+    Lists the files that make up a boundary file (e.g. .shp, .shx, .dbf, .prj for a shapefile)
+
+    Input:
+        shapefile_path - (str) Path to the shapefile or GeoJSON
+    Output:
+        files - (list) Sorted paths of the boundary file and its sidecar files
+
+    """
+    shapefile_path = Path(shapefile_path)
+    if shapefile_path.suffix.lower() != '.shp':
+        return [shapefile_path]
+    return sorted(p for p in shapefile_path.parent.glob(shapefile_path.stem + '.*') if p.is_file())
+
+
+
+def weights_key(lat, lon, crs, shapefile_path, name_col):
+    """
+    Fingerprint of a grid and a boundary file, used to name cached weights
+
+    Inputs:
+        lat - (array) Latitudes of the grid cell centers
+        lon - (array) Longitudes of the grid cell centers
+        crs - (str) Coordinate reference system of the grid
+        shapefile_path - (str) Path to the boundary file
+        name_col - (str) Column of the boundary file with the county names
+    Output:
+        key - (str) Hex digest identifying the weights
+
+    """
+    digest = hashlib.sha256()
+    for coord in (lat, lon):
+        coord = np.ascontiguousarray(coord, dtype='float64')
+        digest.update(str(coord.shape).encode())
+        digest.update(coord.tobytes())
+    digest.update(str(crs).encode())
+    digest.update(str(name_col).encode())
+
+    for path in boundary_files(shapefile_path):
+        digest.update(path.suffix.lower().encode())
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024**2), b''):
+                digest.update(block)
+
+    return digest.hexdigest()
+
+
+
+def read_weights(key, cache_dir=CACHE_DIR):
+    """
+    Reads cached weights and marks them as recently used
+
+    Inputs:
+        key - (str) Fingerprint from weights_key
+        cache_dir - (str) Directory holding the cache
+    Output:
+        cached - (dict or None) matrix, names, lat and lon of the weights, None if not cached
+
+    """
+    path = Path(cache_dir) / (key + '.npz')
+    if not path.is_file():
+        return None
+
+    try:
+        with np.load(path, allow_pickle=False) as npz:
+            matrix = scipy.sparse.csr_matrix((npz['data'], npz['indices'], npz['indptr']),
+                                             shape=tuple(npz['shape']))
+            cached = {'matrix': matrix, 'names': npz['names'], 'lat': npz['lat'], 'lon': npz['lon']}
+    except (OSError, ValueError, KeyError):
+        # Unreadable entries are dropped and recomputed
+        path.unlink(missing_ok=True)
+        return None
+
+    os.utime(path) # Marking as recently used for LRU eviction
+    return cached
+
+
+
+def write_weights(key, matrix, names, lat, lon, cache_dir=CACHE_DIR, max_bytes=MAX_BYTES):
+    """
+    Writes weights to the cache, then evicts the least recently used entries over max_bytes
+
+    Inputs:
+        key - (str) Fingerprint from weights_key
+        matrix - (csr_matrix) County x grid cell weights
+        names - (array) County names
+        lat - (array) Latitudes of the grid cell centers
+        lon - (array) Longitudes of the grid cell centers
+        cache_dir - (str) Directory holding the cache
+        max_bytes - (int) Size cap of the cache directory
+    Output:
+        path - (Path) Location of the cached weights
+
+    """
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    path = cache_dir / (key + '.npz')
+    tmp = cache_dir / (key + '.' + str(os.getpid()) + '.tmp')
+
+    matrix = scipy.sparse.csr_matrix(matrix)
+    with open(tmp, 'wb') as f:
+        np.savez(f, data=matrix.data, indices=matrix.indices, indptr=matrix.indptr,
+                 shape=np.array(matrix.shape), names=np.asarray(names, dtype=str),
+                 lat=np.asarray(lat), lon=np.asarray(lon))
+    os.replace(tmp, path) # Atomic, so readers never see a half written file
+
+    evict(cache_dir, max_bytes, keep=path)
+    return path
+
+
+
+def evict(cache_dir=CACHE_DIR, max_bytes=MAX_BYTES, keep=None):
+    """
+    Deletes the least recently used cached weights until the cache fits in max_bytes
+
+    Inputs:
+        cache_dir - (str) Directory holding the cache
+        max_bytes - (int) Size cap of the cache directory
+        keep - (Path) Entry that should never be evicted (e.g. the one just written)
+
+    """
+    entries = []
+    for path in Path(cache_dir).glob('*.npz'):
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries, key=lambda x: x[0]): # Oldest first
+        if total <= max_bytes:
+            break
+        if keep is not None and path == Path(keep):
+            continue
+        path.unlink(missing_ok=True)
+        total -= size
@@ -0,0 +1,137 @@
+import numpy as np
+import xarray as xr
+
+
+def _segment_reduce(ufunc, gathered, indptr, fill=np.nan):
+    """
+    Reduces each county's run of cells (segments along the last axis) with a numpy ufunc
+
+    """
+    counts = np.diff(indptr)
+    nonempty = counts > 0
+    reduced = np.full(gathered.shape[:-1] + (counts.size,), fill, 
+                      dtype=np.result_type(gathered.dtype, type(fill)))
+    if nonempty.any():
+        # reduceat only works with increasing starts, so counties without cells are left as fill
+        reduced[..., nonempty] = ufunc.reduceat(gathered, indptr[:-1][nonempty], axis=-1)
+    return reduced
+
+
+
+def zonal_kernel(values, matrix, stats, percentiles, threshold):
+    """
+    Computes every statistic for every county from a CSR cell index, in one pass over the data
+
+    Inputs:
+        values - (array) Array with flattened grid cells along the last axis
+        matrix - (csr_matrix) County x grid cell weights (rows are the CSR index of each county)
+        stats - (list) Any of 'mean', 'min', 'max', 'count_above'
+        percentiles - (list) Area weighted percentiles to calculate (0-100)
+        threshold - (float) Threshold for 'count_above'
+    Output:
+        result - (array) Array with statistics then counties along the last two axes
+
+    """
+    lead = values.shape[:-1]
+    flat = values.reshape(-1, values.shape[-1])
+    n_county = matrix.shape[0]
+
+    indptr = matrix.indptr
+    weight = matrix.data
+    counts = np.diff(indptr)
+    seg = np.repeat(np.arange(n_county), counts) # County of every entry of the index
+
+    gathered = flat[:, matrix.indices] # Every county's cells next to each other
+    valid = ~np.isnan(gathered)
+    cell_weight = np.where(valid, weight, 0)
+
+    results = []
+    for stat in stats:
+        if stat == 'mean':
+            with np.errstate(invalid='ignore', divide='ignore'):
+                results.append(_segment_reduce(np.add, np.where(valid, gathered, 0) * weight, indptr) /
+                               _segment_reduce(np.add, cell_weight, indptr))
+        elif stat == 'min':
+            results.append(_segment_reduce(np.fmin, gathered, indptr))
+        elif stat == 'max':
+            results.append(_segment_reduce(np.fmax, gathered, indptr))
+        elif stat == 'count_above':
+            if threshold is None:
+                raise ValueError("count_above needs a threshold")
+            with np.errstate(invalid='ignore'):
+                results.append(_segment_reduce(np.add, (gathered > threshold).astype(float), indptr, fill=0))
+        else:
+            raise ValueError("Unknown statistic: " + str(stat))
+
+    if len(percentiles) > 0:
+        # Sorting values within each county (missing values go to the end of each county)
+        order = np.lexsort((gathered, np.broadcast_to(seg, gathered.shape)), axis=-1)
+        sorted_vals = np.take_along_axis(gathered, order, axis=-1)
+        sorted_weight = np.take_along_axis(cell_weight, order, axis=-1)
+
+        # Cumulative weight within each county
+        totals = _segment_reduce(np.add, sorted_weight, indptr, fill=0)
+        base = np.cumsum(totals, axis=-1) - totals
+        cum = np.cumsum(sorted_weight, axis=-1) - base[:, seg]
+        n_valid = _segment_reduce(np.add, valid.astype(np.int64), indptr, fill=0)
+
+        for q in percentiles:
+            target = totals * (q / 100)
+            # Position of the first value whose cumulative weight reaches the target
+            below = _segment_reduce(np.add, (cum < target[:, seg]).astype(np.int64), indptr, fill=0)
+            pos = indptr[:-1] + np.minimum(below, np.maximum(n_valid - 1, 0))
+            pos = np.minimum(pos, max(weight.size - 1, 0))
+            value = np.take_along_axis(sorted_vals, pos.astype(np.intp), axis=-1)
+            results.append(np.where(n_valid > 0, value, np.nan))
+
+    result = np.stack(results, axis=-2)
+    return result.reshape(lead + result.shape[-2:])
+
+
+
+def zonal_statistics(dataarray, weights, stats=('mean', 'min', 'max'), percentiles=(), threshold=None,
+                     lat='lat', lon='lon'):
+    """
+    Calculates county statistics of a gridded DataArray with precomputed weights. A cell counts
+    towards a county if any of its area falls in the county, and percentiles and means are
+    weighted by that area.
+
+    Inputs:
+        dataarray - (DataArray) Data with lat and lon dimensions (plus any others, e.g. time, model, ens_mem)
+        weights - (CountyWeights) Weights built for the same grid (see calculations.aggregation.county_weights)
+        stats - (list) Any of 'mean', 'min', 'max', 'count_above'
+        percentiles - (list) Area weighted percentiles to calculate (0-100), e.g. [50, 90, 95]
+        threshold - (float) Threshold for 'count_above' (number of cells above it in each county)
+        lat - (str) Name of the latitude dimension
+        lon - (str) Name of the longitude dimension
+    Output:
+        dataset_stats - (Dataset) One variable per statistic ('mean', 'min', 'max', 'count_above', 'p90', ...)
+                        with lat and lon replaced by a county dimension
+
+    """
+    if (dataarray.sizes[lat], dataarray.sizes[lon]) != weights.shape:
+        raise ValueError("Grid of the dataset does not match the grid of the weights")
+
+    stats = list(stats)
+    percentiles = list(percentiles)
+    names = stats + ['p' + format(q, 'g') for q in percentiles]
+
+    if dataarray.chunks is not None:
+        # Each chunk needs the whole grid
+        dataarray = dataarray.chunk({lat: -1, lon: -1})
+
+    def _zonal(values):
+        values = values.reshape(values.shape[:-2] + (-1,))
+        return zonal_kernel(values, weights.matrix, stats, percentiles, threshold)
+
+    result = xr.apply_ufunc(_zonal, dataarray,
+                            input_core_dims=[[lat, lon]],
+                            output_core_dims=[['stat', 'county']],
+                            dask='parallelized',
+                            output_dtypes=[np.float64],
+                            dask_gufunc_kwargs={'output_sizes': {'stat': len(names),
+                                                                 'county': weights.names.size}})
+    result = result.assign_coords(stat=names, county=weights.names)
+
+    dataset_stats = result.to_dataset('stat')
+    return dataset_stats
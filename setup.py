@@ -10,6 +10,7 @@ setuptools.setup(
     url="https://github.com/mailesasaki/climate_map",
     scripts=['LOCA2/LOCA2_download.py',
              'LOCA2/LOCA2_processor.py',
+             'LOCA2/LOCA2_zarr.py',
              'NEX_GDDP_CMIP6/nex_gddp_cmip6_download_il.py',
              'NEX_GDDP_CMIP6/NEX_GDDP_CMIP6_processor.py',
              ],
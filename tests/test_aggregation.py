@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+
+xr = pytest.importorskip('xarray')
+pytest.importorskip('geopandas')
+scipy_sparse = pytest.importorskip('scipy.sparse')
+
+from calculations import aggregation
+
+
+def grid_weights(lat, lon, n_counties=3, seed=0):
+    """
+    Random cell to county weights for a grid (each cell split between the counties)
+
+    """
+    rng = np.random.default_rng(seed)
+    matrix = rng.random((n_counties, lat.size * lon.size))
+    matrix /= matrix.sum(axis=0)
+    names = ['County ' + str(i) for i in range(n_counties)]
+    return aggregation.CountyWeights(scipy_sparse.csr_matrix(matrix), names, lat, lon)
+
+
+@pytest.mark.parametrize('chunked', [False, True])
+def test_parallel_matches_aggregate_counties(chunked):
+    lat, lon = np.arange(36.0, 40.0), np.arange(268.0, 273.0)
+    rng = np.random.default_rng(1)
+    dataarray = xr.DataArray(rng.random((2, 40, lat.size, lon.size)).astype('float32'),
+                             dims=('ens_mem', 'time', 'lat', 'lon'),
+                             coords={'time': np.arange(40), 'lat': lat, 'lon': lon}, name='tasmax')
+    if chunked:
+        pytest.importorskip('dask')
+        dataarray = dataarray.chunk({'time': 7})
+    weights = grid_weights(lat, lon)
+
+    parallel = aggregation.parallel_aggregate_counties(dataarray, weights, processes=2, block_size=9)
+
+    expected = aggregation.aggregate_counties(dataarray, weights).transpose(*parallel.dims)
+    np.testing.assert_allclose(parallel.values, expected.values, rtol=1e-5)
+    assert list(parallel['county'].values) == list(weights.names)
@@ -0,0 +1,236 @@
+import hashlib
+import http.server
+import re
+import threading
+import time
+
+import pytest
+
+pytest.importorskip('requests')
+pytest.importorskip('bs4')
+
+from LOCA2 import LOCA2_download
+
+
+MODELS = {'ACCESS-CM2': {'ssp245': {'r1i1p1f1', 'r2i1p1f1'}}}
+YEARS = ['2015-2044', '2045-2074', '2075-2100']
+SIZE = 64 * 1024
+
+
+def file_names(memberid):
+    return ['tasmax.ACCESS-CM2.ssp245.' + memberid + '.' + years + '.LOCA_16thdeg_v20220413.cent.nc'
+            for years in YEARS]
+
+
+def content(name):
+    """
+    Bytes the stand-in serves for a file (different for every file, so checksums mean something)
+
+    """
+    return (name.encode() * (SIZE // len(name) + 1))[:SIZE]
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves index pages (with an ETag, answering If-None-Match with 304) and files (honoring Range 
+    requests) laid out like the LOCA2 server, counting downloads in flight and recording the Range 
+    of every file request
+
+    """
+    lock = threading.Lock()
+    active = 0
+    max_active = 0
+    ranges = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header('Content-Length', str(SIZE))
+        self.end_headers()
+
+    def do_GET(self):
+        parts = self.path.strip('/').split('/')
+        if self.path.endswith('/'):
+            # model/cent/0p0625deg/member/scenario/variable/
+            links = file_names(parts[3]) if len(parts) == 6 else []
+            body = ''.join('<a href="' + name + '">' + name + '</a>' for name in ['../'] + links).encode()
+            etag = '"' + hashlib.sha256(body).hexdigest()[:16] + '"'
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        cls = type(self)
+        body = content(parts[-1])
+        requested = self.headers.get('Range')
+        with cls.lock:
+            cls.active += 1
+            cls.max_active = max(cls.max_active, cls.active)
+            cls.ranges.append((parts[-1], requested))
+        try:
+            time.sleep(0.2)
+            offset = int(re.match(r'bytes=(\d+)-$', requested).group(1)) if requested else 0
+            if offset >= len(body):
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */' + str(len(body)))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            if requested:
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes ' + str(offset) + '-' + str(len(body) - 1) + '/' + str(len(body)))
+            else:
+                self.send_response(200)
+            self.send_header('Content-Length', str(len(body) - offset))
+            self.end_headers()
+            self.wfile.write(body[offset:])
+        finally:
+            with cls.lock:
+                cls.active -= 1
+
+
+@pytest.fixture
+def server():
+    StandInHandler.active = 0
+    StandInHandler.max_active = 0
+    StandInHandler.ranges = []
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield 'http://127.0.0.1:' + str(httpd.server_address[1]) + '/'
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_downloads_concurrently_within_host_limit(server, tmp_path):
+    LOCA2_download.file_downloader('tasmax', str(tmp_path / 'out'), base_url=server, models=MODELS,
+                                   max_workers=6, per_host=2, index_cache=tmp_path / 'index.json')
+
+    assert StandInHandler.max_active == 2
+
+
+def test_summary_and_rerun(server, tmp_path):
+    out = tmp_path / 'out'
+    summary = LOCA2_download.file_downloader('tasmax', str(out), base_url=server, models=MODELS,
+                                             max_workers=4, per_host=4, index_cache=tmp_path / 'index.json')
+
+    assert summary['downloaded'] == 6
+    assert summary['failed'] == 0
+    assert summary['bytes'] == 6 * SIZE
+    assert sorted(path.name for path in (out / 'ACCESS-CM2' / 'ssp245').iterdir()) == sorted(
+        file_names('r1i1p1f1') + file_names('r2i1p1f1'))
+
+    summary = LOCA2_download.file_downloader('tasmax', str(out), base_url=server, models=MODELS,
+                                             max_workers=4, per_host=4, index_cache=tmp_path / 'index.json')
+    assert summary['downloaded'] == 0
+    assert summary['skipped'] == 6
+
+
+def test_index_pages_revalidated(server, tmp_path, capsys):
+    index_cache = tmp_path / 'index.json'
+    LOCA2_download.file_downloader('tasmax', str(tmp_path / 'out'), base_url=server, models=MODELS,
+                                   max_workers=4, per_host=4, index_cache=index_cache)
+    assert '2 index pages fetched, 0 unchanged' in capsys.readouterr().out
+    pages = LOCA2_download.read_manifest(index_cache)
+    assert all(page['etag'] for page in pages.values())
+
+    summary = LOCA2_download.file_downloader('tasmax', str(tmp_path / 'out'), base_url=server, models=MODELS,
+                                             max_workers=4, per_host=4, index_cache=index_cache)
+
+    assert '0 index pages fetched, 2 unchanged' in capsys.readouterr().out
+    assert LOCA2_download.read_manifest(index_cache) == pages
+    assert summary['skipped'] == 6
+
+
+def test_adopts_files_without_manifest(server, tmp_path):
+    out = tmp_path / 'out'
+    directory = out / 'ACCESS-CM2' / 'ssp245'
+    directory.mkdir(parents=True)
+    complete, truncated = file_names('r1i1p1f1')[:2]
+    (directory / complete).write_bytes(content(complete))
+    (directory / truncated).write_bytes(content(truncated)[:SIZE // 2])
+
+    summary = LOCA2_download.file_downloader('tasmax', str(out), base_url=server, models=MODELS,
+                                             max_workers=4, per_host=4, index_cache=tmp_path / 'index.json')
+
+    assert summary['skipped'] == 1
+    assert summary['downloaded'] == 5
+    assert summary['bytes'] == 4 * SIZE + SIZE // 2
+    manifest = LOCA2_download.read_manifest(out / LOCA2_download.MANIFEST)
+    assert manifest['ACCESS-CM2/ssp245/' + complete]['sha256'] == hashlib.sha256(content(complete)).hexdigest()
+    assert (directory / truncated).read_bytes() == content(truncated)
+    assert complete not in [name for name, _ in StandInHandler.ranges]
+
+
+def test_resumes_partial_download(server, tmp_path):
+    out = tmp_path / 'out'
+    directory = out / 'ACCESS-CM2' / 'ssp245'
+    directory.mkdir(parents=True)
+    name = file_names('r1i1p1f1')[0]
+    (directory / (name + '.part')).write_bytes(content(name)[:SIZE // 4])
+
+    summary = LOCA2_download.file_downloader('tasmax', str(out), base_url=server, models=MODELS,
+                                             max_workers=4, per_host=4, index_cache=tmp_path / 'index.json')
+
+    assert summary['downloaded'] == 6
+    assert summary['bytes'] == 5 * SIZE + SIZE - SIZE // 4
+    assert (name, 'bytes=' + str(SIZE // 4) + '-') in StandInHandler.ranges
+    assert (directory / name).read_bytes() == content(name)
+    assert not (directory / (name + '.part')).exists()
+
+
+@pytest.mark.parametrize('extra', [0, 10])
+def test_range_not_satisfiable(server, tmp_path, extra):
+    # A complete .part gets a 416 and is only renamed, one longer than the file is downloaded again
+    out = tmp_path / 'out'
+    directory = out / 'ACCESS-CM2' / 'ssp245'
+    directory.mkdir(parents=True)
+    name = file_names('r1i1p1f1')[0]
+    (directory / (name + '.part')).write_bytes(content(name) + b'x' * extra)
+
+    summary = LOCA2_download.file_downloader('tasmax', str(out), base_url=server, models=MODELS,
+                                             max_workers=4, per_host=4, index_cache=tmp_path / 'index.json')
+
+    assert summary['downloaded'] == 6
+    assert summary['failed'] == 0
+    assert summary['bytes'] == 5 * SIZE + (SIZE if extra else 0)
+    assert (name, 'bytes=' + str(SIZE + extra) + '-') in StandInHandler.ranges
+    assert (directory / name).read_bytes() == content(name)
+
+
+def test_corrupted_files(server, tmp_path):
+    out = tmp_path / 'out'
+    directory = out / 'ACCESS-CM2' / 'ssp245'
+    LOCA2_download.file_downloader('tasmax', str(out), base_url=server, models=MODELS,
+                                   max_workers=4, per_host=4, index_cache=tmp_path / 'index.json')
+    corrupted, truncated = file_names('r1i1p1f1')[:2]
+    (directory / corrupted).write_bytes(b'y' * SIZE)
+    (directory / truncated).write_bytes(b'y' * (SIZE // 2))
+
+    # The truncated file gets resumed, but the result doesn't match the checksum in the manifest
+    summary = LOCA2_download.file_downloader('tasmax', str(out), base_url=server, models=MODELS, max_workers=4,
+                                             per_host=4, verify=True, index_cache=tmp_path / 'index.json')
+
+    assert summary['skipped'] == 4
+    assert summary['downloaded'] == 1
+    assert summary['failed'] == 1
+    assert (directory / corrupted).read_bytes() == content(corrupted)
+    assert not (directory / truncated).exists()
+    assert not (directory / (truncated + '.part')).exists()
+
+    # Downloaded from scratch on the next run
+    summary = LOCA2_download.file_downloader('tasmax', str(out), base_url=server, models=MODELS, max_workers=4,
+                                             per_host=4, verify=True, index_cache=tmp_path / 'index.json')
+
+    assert summary['downloaded'] == 1
+    assert summary['skipped'] == 5
+    assert (directory / truncated).read_bytes() == content(truncated)
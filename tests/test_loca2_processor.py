@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+
+xr = pytest.importorskip('xarray')
+pytest.importorskip('netCDF4')
+
+from LOCA2 import LOCA2_processor
+
+
+LAT = np.arange(37.0, 42.0, 0.5)
+LON = np.arange(268.0, 273.0, 0.5)
+
+
+def write_member(directory, memberid, years=((2015, 2016), (2017, 2018), (2019, 2020)), calendar='noleap'):
+    """
+    Writes one member as a file per block of years, like the LOCA2 files, chunked along time on disk
+
+    """
+    paths = []
+    start = 0
+    for first, last in years:
+        if calendar == 'noleap':
+            days = (last - first + 1) * 365
+        else:
+            days = (np.datetime64(str(last + 1) + '-01-01') - np.datetime64(str(first) + '-01-01')).astype(int)
+        time = np.arange(start, start + days, dtype='float64')
+        values = np.broadcast_to(np.sin(time / 58.0)[:, None, None] + 290.0, (days, LAT.size, LON.size))
+        dataset = xr.Dataset({'tasmax': (('time', 'lat', 'lon'), values.astype('float32'), {'units': 'K'})},
+                             coords={'time': ('time', time, {'units': 'days since 2015-01-01', 'calendar': calendar}),
+                                     'lat': LAT, 'lon': LON})
+        path = directory / ('tasmax.' + memberid + '.' + str(first) + '-' + str(last) + '.nc')
+        dataset.to_netcdf(path, engine='netcdf4', encoding={'tasmax': {'chunksizes': (30, LAT.size, LON.size)}})
+        paths.append(str(path))
+        start += days
+    return paths
+
+
+def test_opens_members_from_many_threads(tmp_path):
+    tasks = [('MODEL', 'r' + str(i) + 'i1p1f1', write_member(tmp_path, 'r' + str(i) + 'i1p1f1')) for i in range(16)]
+
+    members = list(LOCA2_processor.iter_members(tasks, 'tasmax', 2015, 2020, max_workers=8))
+
+    assert [mem for _, mem, _ in members] == [mem for _, mem, _ in tasks]
+    for _, _, dataset_mem in members:
+        assert dataset_mem.sizes['time'] == 6 * 365
+        assert float(dataset_mem['tasmax'].mean()) == pytest.approx(290.0, abs=0.1)
+
+
+@pytest.mark.parametrize('leap_day', ['drop', 'fill', 'interpolate'])
+def test_open_member_time_chunked(tmp_path, leap_day):
+    paths = write_member(tmp_path, 'r1i1p1f1')
+
+    dataset_mem = LOCA2_processor.open_member(paths, 'tasmax', 2015, 2020, leap_day=leap_day)
+
+    # 2016 and 2020 are leap years missing from the noleap calendar
+    assert dataset_mem.sizes['time'] == 6 * 365 + (0 if leap_day == 'drop' else 2)
+    if leap_day == 'fill':
+        assert bool(dataset_mem['tasmax'].sel(time='2016-02-29').isnull().all())
+    elif leap_day == 'interpolate':
+        assert not bool(dataset_mem['tasmax'].sel(time='2016-02-29').isnull().any())
+
+
+def test_incremental_uneven_files(tmp_path, monkeypatch):
+    pytest.importorskip('zarr')
+    # Standard calendar files of 1826, 1827 and 1095 days, and a first year that isn't a file boundary
+    years = ((2015, 2019), (2020, 2024), (2025, 2027))
+    tasks = [('MODEL', mem, write_member(tmp_path, mem, years, calendar='standard')) for mem in ('r1i1p1f1', 'r2i1p1f1')]
+    monkeypatch.setattr(LOCA2_processor, 'member_tasks', lambda *args: tasks)
+    store = str(tmp_path / 'out.zarr')
+
+    LOCA2_processor.incremental_loca2(store, 'ssp245', 'tasmax', 2016, 2027, max_workers=2)
+
+    assert LOCA2_processor.read_manifest(store)['completed'] == ['MODEL/r1i1p1f1', 'MODEL/r2i1p1f1']
+    dataset = LOCA2_processor.open_incremental(store)
+    assert dataset.sizes['ens_mem'] == 2
+    assert dataset.sizes['time'] == (np.datetime64('2028-01-01') - np.datetime64('2016-01-01')).astype(int)